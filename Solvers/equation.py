@@ -1,17 +1,159 @@
-"""Module solving math problem afterwards"""
+"""Module solving math problem afterwards
+
+The equation is read from the monument text in Dumps/phrases.txt where the
+'^' of the powers are not printable, so the phrase breaks inside the template
+are read back as '^'. Blanks are assigned term by term and a branch is
+pruned as soon as the remaining terms can not reach the target anymore; the
+last coins are tried all at once as a NumPy batch of permutations.
+"""
+import re
+import math
+import argparse
 import itertools
+from functools import cache
+import numpy as np
+
+HEADER = re.compile(r"^\[\d+ \]")
+BATCH_SIZE = 7
+COINS = {'red coin': 2, 'corroded coin': 3, 'shiny coin': 5, 'concave coin': 7, 'blue coin': 9}
+
+
+def monument(filename="Dumps/phrases.txt"):
+    """ Equation template of the monument
+
+    Args:
+        filename (string, optional): phrases written by decoder.py
+
+    Returns:
+        string : the template, like "_ + _ * _^2 + _^3 - _ = 399"
+    """
+    with open(filename) as file:
+        lines = file.read().splitlines()
+    start = next(index for (index, line) in enumerate(lines) if "monument" in line and line.endswith("It reads:"))
+    template = ""
+    for line in lines[start + 1:]:
+        if HEADER.match(line):
+            template += "^" + HEADER.sub("", line)
+        else:
+            template += " " + line
+        if "=" in template:
+            return " ".join(template.split())
+    raise ValueError("The monument equation is not complete")
+
+def parse(template):
+    """ Parses a template made of terms of blanks, powers and numbers
+
+    Args:
+        template (string): equation like "_ + _ * _^2 + _^3 - _ = 399"
+
+    Returns:
+        (list, int, int) : terms (sign, constant, exponent of each blank), number of blanks, target
+    """
+    (expression, target) = template.replace(" ", "").split("=")
+    terms, blanks = [], 0
+    for (sign, term) in re.findall(r"([+-]?)([^+-]+)", expression):
+        constant, exponents = 1, []
+        for factor in term.split("*"):
+            (base, _, exponent) = factor.partition("^")
+            if base == "_":
+                exponents.append(int(exponent or 1))
+                blanks += 1
+            else:
+                constant *= int(base) ** int(exponent or 1)
+        terms.append((-1 if sign == "-" else 1, constant, exponents))
+    return (terms, blanks, int(target))
+
+def bounds(terms, coins):
+    """ Smallest and largest values the terms can take with the coins (positive coins)
+    """
+    (smallest, largest) = (min(coins), max(coins))
+    low = high = 0
+    for (sign, constant, exponents) in terms:
+        values = (sign * constant * math.prod(smallest ** e for e in exponents),
+                  sign * constant * math.prod(largest ** e for e in exponents))
+        low, high = low + min(values), high + max(values)
+    return (low, high)
+
+@cache
+def permutations(count):
+    """ All the orders of count items, one per row
+    """
+    return np.array(list(itertools.permutations(range(count))), dtype=np.intp).reshape(-1, count)
+
+def evaluate(terms, values, dtype=object):
+    """ Values of the terms for a batch of assignments
+
+    Args:
+        terms (list): terms as returned by parse
+        values (ndarray): one row per assignment, one column per blank of the terms
+        dtype (type, optional): integer type of the computation, np.int64 when
+                                the values are known to fit. Defaults to object.
+
+    Returns:
+        ndarray : value of each assignment
+    """
+    total, column = np.zeros(len(values), dtype=dtype), 0
+    for (sign, constant, exponents) in terms:
+        term = np.full(len(values), sign * constant, dtype=dtype)
+        for exponent in exponents:
+            term = term * values[:, column].astype(dtype) ** exponent
+            column += 1
+        total = total + term
+    return total
+
+def solve(template, coins):
+    """ Assignment of the coins to the blanks satisfying the equation
+
+    Args:
+        template (string): equation template
+        coins (dict): value of each coin
+
+    Returns:
+        list : coin names in the order of the blanks, None if there is none
+    """
+    (terms, blanks, target) = parse(template)
+    names = list(coins)
+    if blanks != len(names):
+        raise ValueError(f"{blanks} blanks for {len(names)} coins")
+    prune = min(coins.values()) > 0
+    (low, high) = bounds(terms, list(coins.values())) if prune else (None, None)
+    dtype = np.int64 if prune and max(-low, high, abs(target)) < 2 ** 62 else object
+    def search(term, partial, remaining, chosen):
+        rest = terms[term:]
+        if prune and remaining:
+            (low, high) = bounds(rest, [coins[name] for name in remaining])
+            if not low <= target - partial <= high:
+                return None
+        if len(remaining) <= BATCH_SIZE:
+            orders = permutations(len(remaining))
+            values = np.array([coins[name] for name in remaining])[orders]
+            matches = np.flatnonzero(evaluate(rest, values, dtype) == target - partial)
+            return chosen + [remaining[index] for index in orders[matches[0]]] if len(matches) else None
+        (sign, constant, exponents) = terms[term]
+        for order in itertools.permutations(remaining, len(exponents)):
+            value = sign * constant
+            for (name, exponent) in zip(order, exponents):
+                value *= coins[name] ** exponent
+            result = search(term + 1, partial + value, [name for name in remaining if name not in order],
+                            chosen + list(order))
+            if result:
+                return result
+        return None
+    return search(0, 0, names, [])
+
 
-"""Solve equation by brute force"""
 if __name__ == '__main__':
-    BLUE = 9
-    RED = 2
-    SHINY = 5
-    CONCAVE = 7
-    CORRODED = 3
-
-    coins = [RED, BLUE, SHINY, CONCAVE, CORRODED]
-
-    for (a,b,c,d,e) in itertools.permutations(coins) :
-        if a + b * c**2 + d**3 - e == 399:
-            print("Solution is ", [ a, b, c, d, e])
-            break
+    parser = argparse.ArgumentParser(description="Finds the order of the coins for the monument")
+    parser.add_argument('--phrases', default="Dumps/phrases.txt")
+    parser.add_argument('--template', help="equation, read from the phrases by default")
+    parser.add_argument('--coin', action='append', metavar="NAME=VALUE",
+                        help="coin and its value (repeat), defaults to the five coins of the game")
+    arguments = parser.parse_args()
+    template = arguments.template or monument(arguments.phrases)
+    coins = dict((name.strip(), int(value)) for (name, value) in
+                 (coin.split("=") for coin in arguments.coin)) if arguments.coin else COINS
+    solution = solve(template, coins)
+    if solution is None:
+        print(f"No solution for {template}")
+    else:
+        print("\n".join(f"use {name}" for name in solution))
@@ -0,0 +1,198 @@
+""" Finds the value of the eighth register expected by the teleporter check
+
+The function at 6027 (see function.asm) is an Ackermann like recursion where
+rh plays the role of a parameter h:
+    f(0, b) = b + 1
+    f(a, 0) = f(a - 1, h)
+    f(a, b) = f(a - 1, f(a, b - 1))
+Each row f(a, .) is computed as a table from the previous one, for a batch of
+candidates at once, and the batches are spread over a process pool. NumPy and
+multiprocessing are only imported when the cache misses.
+"""
+import os
+import sys
+import re
+import json
+import hashlib
+import argparse
+from array import array
+
+MODULUS = 32768
+CACHE = "Solvers/teleporter.json"
+BATCH_SIZE = 1024
+SHAPE = ['jt', 'add', 'ret', 'jt', 'add', 'set', 'call', 'ret',
+         'push', 'add', 'call', 'set', 'pop', 'add', 'call', 'ret']
+LINE = re.compile(r"\[(\d+)\s*\]\s+(\w+)\s*([^;]*)")
+# set ra <a>, set rb <b>, call <function>, eq rb ra <target>
+CALL_SITE = (1, MODULUS, None, 1, MODULUS + 1, None, 17, None, 4, MODULUS + 1, MODULUS, None)
+
+
+def read_function(filename="Solvers/function.asm"):
+    """ Reads the semantics of the recursive function from its listing
+
+    Args:
+        filename (string, optional): path of the listing
+
+    Raises:
+        ValueError: if the listing is not the expected recursion
+
+    Returns:
+        dict : address of the function and increment of f(0, b)
+    """
+    with open(filename) as file:
+        lines = [LINE.match(line) for line in file if line.strip()]
+    operations = [(int(line[1]), line[2], [arg.strip() for arg in line[3].split(",") if arg.strip()])
+                  for line in lines if line]
+    if [name for (_, name, _) in operations] != SHAPE:
+        raise ValueError(f"{filename} is not the expected recursive function")
+    (address, _, _) = operations[0]
+    (_, _, increment) = operations[1]
+    return {'address': address, 'increment': int(increment[2])}
+
+def find_call_site(program, function):
+    """ Finds the arguments and the expected result of the call to the function
+
+    Args:
+        program (array): words of the program
+        function (int): address of the function
+
+    Raises:
+        ValueError: if the call is not found
+
+    Returns:
+        (int, int, int) : a, b and the expected result
+    """
+    pattern = list(CALL_SITE)
+    pattern[7] = function
+    for start in range(len(program) - len(pattern)):
+        window = program[start:start + len(pattern)]
+        if all(expected is None or word == expected for (word, expected) in zip(window, pattern)):
+            return (window[2], window[5], window[11])
+    raise ValueError(f"No call to {function} found")
+
+def value(a, b, h, increment=1):
+    """ Computes f(a, b) for one value of h, row by row
+
+    Args:
+        a (int): first argument
+        b (int): second argument
+        h (int): value of the eighth register
+        increment (int, optional): increment of f(0, b)
+
+    Returns:
+        int : f(a, b)
+    """
+    row = [(column + increment) % MODULUS for column in range(MODULUS)]
+    for level in range(1, a + 1):
+        length = MODULUS if level < a else b + 1
+        current = row[h]
+        table = [current]
+        for _ in range(1, length):
+            current = row[current]
+            table.append(current)
+        row = table
+    return row[b]
+
+def evaluate(candidates, a, b, increment=1):
+    """ Computes f(a, b) for a batch of values of h
+
+    Args:
+        candidates (list): values of h
+        a (int): first argument
+        b (int): second argument
+        increment (int, optional): increment of f(0, b)
+
+    Returns:
+        list : f(a, b) for each candidate
+    """
+    import numpy as np
+    width = len(candidates)
+    h = np.asarray(candidates, dtype=np.int64)
+    columns = np.arange(width)
+    # tables are indexed [b, candidate] so that a row is contiguous
+    previous = np.repeat(((np.arange(MODULUS) + increment) % MODULUS).astype(np.uint16), width)
+    index = np.empty(width, dtype=np.int64)
+    for level in range(1, a + 1):
+        length = MODULUS if level < a else b + 1
+        table = np.empty(length * width, dtype=np.uint16)
+        current = previous.take(h * width + columns)
+        table[:width] = current
+        for row in range(1, length):
+            np.multiply(current, width, out=index, dtype=np.int64)
+            index += columns
+            current = previous.take(index)
+            table[row * width:(row + 1) * width] = current
+        previous = table
+    return previous[b * width:(b + 1) * width].tolist()
+
+def check_batch(arguments):
+    """ Pool task evaluating a batch of candidates
+
+    Returns:
+        list : the candidates giving the target
+    """
+    (candidates, a, b, increment, target) = arguments
+    return [h for (h, value) in zip(candidates, evaluate(candidates, a, b, increment)) if value == target]
+
+def search(a, b, target, increment=1, processes=None, batch_size=BATCH_SIZE):
+    """ Smallest h such that f(a, b) == target, the pool is terminated as soon
+    as a batch (in order) contains a match
+
+    Returns:
+        int : h, None if there is none
+    """
+    import multiprocessing
+    tasks = [(list(range(start, min(start + batch_size, MODULUS))), a, b, increment, target)
+             for start in range(0, MODULUS, batch_size)]
+    with multiprocessing.Pool(processes) as pool:
+        for found in pool.imap(check_batch, tasks):
+            if found:
+                pool.terminate()
+                return found[0]
+    return None
+
+def solve(program="Program/challenge.bin", listing="Solvers/function.asm", cache=CACHE, processes=None):
+    """ Value of the eighth register passing the teleporter check, cached by
+    the hash of the program
+
+    Args:
+        program (string, optional): path to the program
+        listing (string, optional): listing of the recursive function
+        cache (string, optional): path of the cache file, None to always search
+        processes (int, optional): number of worker processes. Defaults to the number of cores.
+
+    Returns:
+        int : the value of the register
+    """
+    with open(program, 'rb') as file:
+        content = file.read()
+    key = hashlib.sha256(content).hexdigest()
+    results = {}
+    if cache and os.path.exists(cache):
+        with open(cache) as file:
+            results = json.load(file)
+    if key in results:
+        return results[key]['h']
+    print(f"Searching the value of the eighth register for {program}, this takes a minute "
+          f"on one core{' (cached in ' + cache + ')' if cache else ''}...", file = sys.stderr, flush = True)
+    function = read_function(listing)
+    words = array('H')
+    words.frombytes(content)
+    (a, b, target) = find_call_site(words, function['address'])
+    h = search(a, b, target, function['increment'], processes)
+    results[key] = {'a': a, 'b': b, 'target': target, 'h': h}
+    if cache:
+        with open(cache, 'w') as file:
+            json.dump(results, file, indent=2)
+    return h
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Finds the value of the eighth register for the teleporter")
+    parser.add_argument('--program', default="Program/challenge.bin")
+    parser.add_argument('--listing', default="Solvers/function.asm")
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--no-cache', action='store_true', help="always search")
+    arguments = parser.parse_args()
+    print(solve(arguments.program, arguments.listing, None if arguments.no_cache else CACHE,
+                arguments.processes))
@@ -1,43 +1,88 @@
-""" Solves the vault puzzle by brute force
+""" Solves the vault puzzle by breadth first search
+
+The grid is given row by row starting from the row of the start cell (south)
+going north, each cell being a number or an operation. Walking on an
+operation remembers it, walking on a number applies the pending operation to
+the orb weight. The start cell can not be visited again and the walk ends as
+soon as it reaches the vault door.
 """
-from collections import defaultdict
+import argparse
+from collections import deque
 
+OPERATIONS = {
+    '+': lambda a, b: a + b,
+    '-': lambda a, b: a - b,
+    '*': lambda a, b: a * b,
+}
+DIRECTIONS = (('north', 1, 0), ('south', -1, 0), ('east', 0, 1), ('west', 0, -1))
 
-grid = [
-    ['22', '-', '9', '*'],
-    ['+', '4', '-', '18'],
-    ['4', '*', '11', '*'],
-    ['*', '8', '-', '1']
-]
 
-def evaluate(expression):
-    """ evaluate expression if terminal (not ending with an operation)
-    """
-    if expression[-1] in ['-','*','+']:
-        return expression
-    return str(eval(expression))
-def neighbors(i: int, j: int):
-    """ neighbors
+def solve(grid, target, start=(0, 0), end=None, bound=(1, 32767)):
+    """ Shortest walk from start to end bringing the weight to target
+
+    States are (cell, weight, pending operation), each one visited once and
+    linked to its parent, weights outside of bound are pruned.
+
+    Args:
+        grid (list): rows of cells, numbers as int and operations as strings
+        target (int): expected weight at the vault door
+        start (tuple, optional): start cell (row, column). Defaults to (0, 0).
+        end (tuple, optional): vault door cell. Defaults to the last cell.
+        bound (tuple, optional): allowed weights (inclusive).
+
+    Returns:
+        list : directions of the walk, None if there is none
     """
-    all_corners = [(i, j-1), (i, j+1), (i-1, j), (i+1, j)]
-    return [(x, y) for (x, y) in all_corners if (0 <= x <= 3 and 0 <= y <= 3)]
-
-results = defaultdict(set) # key = (i,j) ; all possible results
-paths = defaultdict(lambda : defaultdict(list)) # All possible paths of each possible result (i,j) => result => list
-results[(0,0)].add('22')
-paths[(0,0)]['22'].append('22')
-
-for x in range(4):
-    for i in range(0,4):
-        for j in range (0,4):
-            if i == 0 and j ==0 :
+    end = end or (len(grid) - 1, len(grid[-1]) - 1)
+    root = (start, grid[start[0]][start[1]], None)
+    parents = {root: None}
+    queue = deque([root])
+    while queue:
+        state = queue.popleft()
+        ((row, column), weight, pending) = state
+        for (direction, down, right) in DIRECTIONS:
+            cell = (row + down, column + right)
+            if not (0 <= cell[0] < len(grid) and 0 <= cell[1] < len(grid[cell[0]])) or cell == start:
                 continue
-            for x in neighbors(i,j):
-                digit=grid[i][j]
-                for r in results[x]:
-                    result=evaluate(r+digit)
-                    results[(i,j)].add(result)
-                    paths[(i,j)][result] = paths[(i,j)][result] + [ a + digit for a in paths[x][r]]
-print(results[(3,3)])
-print('30' in results[(3,3)])
-print(paths[(3,3)]['30'])
\ No newline at end of file
+            content = grid[cell[0]][cell[1]]
+            if isinstance(content, str):
+                following = (cell, weight, content)
+            else:
+                following = (cell, OPERATIONS[pending](weight, content), None)
+                if not bound[0] <= following[1] <= bound[1]:
+                    continue
+            if following in parents:
+                continue
+            parents[following] = (state, direction)
+            if cell == end:
+                if following[1] != target:
+                    continue
+                path = []
+                while parents[following]:
+                    (following, direction) = parents[following]
+                    path.append(direction)
+                return path[::-1]
+            queue.append(following)
+    return None
+
+def parse(rows):
+    """ Grid from rows of space separated cells
+    """
+    return [[cell if cell in OPERATIONS else int(cell) for cell in row.split()] for row in rows]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Finds the shortest walk opening the vault")
+    parser.add_argument('--grid', nargs='+', default=["22 - 9 *", "+ 4 - 18", "4 * 11 *", "* 8 - 1"],
+                        help="rows of the grid from the start row, cells separated by spaces")
+    parser.add_argument('--target', type=int, default=30)
+    parser.add_argument('--start', type=int, nargs=2, default=(0, 0), metavar=('ROW', 'COLUMN'))
+    parser.add_argument('--end', type=int, nargs=2, default=None, metavar=('ROW', 'COLUMN'))
+    parser.add_argument('--bound', type=int, nargs=2, default=(1, 32767), metavar=('MIN', 'MAX'))
+    arguments = parser.parse_args()
+    walk = solve(parse(arguments.grid), arguments.target, tuple(arguments.start),
+                 arguments.end and tuple(arguments.end), tuple(arguments.bound))
+    if walk is None:
+        print("No solution")
+    else:
+        print("\n".join(f"go {direction}" for direction in walk))
@@ -0,0 +1,162 @@
+""" Module storing memory dumps as differences against a base checkpoint"""
+import sys
+import json
+import zlib
+import struct
+import difflib
+import argparse
+from array import array
+from constants import MAX_ADDRESS
+
+RECORD_HEADER = struct.Struct('<IIII')
+
+
+class DumpArchive:
+    """ Checkpoints of the memory and of its listing: the first one is stored
+    whole, the next ones only keep the words and listing entries that differ
+    from it. Records are appended to Dumps/{name}.dif, Dumps/{name}.idx holds
+    one JSON line per checkpoint (name, offset and size of its record).
+    """
+    def __init__(self, name, folder="Dumps"):
+        self.path = f"{folder}/{name}"
+        self.index = {}
+        self.order = []
+        self.base = None
+        try:
+            with open(f"{self.path}.idx") as file:
+                for line in file:
+                    entry = json.loads(line)
+                    self.index[entry['name']] = entry
+                    self.order.append(entry['name'])
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        """ Removes all the checkpoints
+        """
+        for extension in ("dif", "idx"):
+            open(f"{self.path}.{extension}", 'wb').close()
+        (self.index, self.order, self.base) = ({}, [], None)
+
+    def add(self, name, image, records):
+        """ Appends a checkpoint
+
+        Args:
+            name (string): name of the checkpoint
+            image (array): memory words (MAX_ADDRESS of them)
+            records (iterable): listing entries (address, text)
+        """
+        (image, listing) = (image[:MAX_ADDRESS], dict(records))
+        if not self.order:
+            body = self.encode(image, array('H'), array('H'), listing)
+        else:
+            (base_image, base_listing) = self.checkpoint(self.order[0])
+            addresses = array('H', (address for address in range(MAX_ADDRESS)
+                                    if image[address] != base_image[address])
+                              if image[:MAX_ADDRESS] != base_image else ())
+            removed = array('H', (address for address in base_listing if address not in listing))
+            changed = {address: text for (address, text) in listing.items()
+                       if base_listing.get(address) != text}
+            body = self.encode(addresses, array('H', map(image.__getitem__, addresses)), removed, changed)
+        with open(f"{self.path}.dif", 'ab') as file:
+            offset = file.tell()
+            file.write(body)
+        entry = {'name': name, 'offset': offset, 'size': len(body), 'words': len(image) if not self.order
+                 else len(addresses)}
+        with open(f"{self.path}.idx", 'a') as file:
+            print(json.dumps(entry), file = file)
+        self.index[name] = entry
+        self.order.append(name)
+
+    def encode(self, words, values, removed, listing):
+        """ Compressed record: changed addresses, their values, the addresses
+        of the removed listing entries and the changed entries
+        """
+        text = "\0".join(f"{address}:{line}" for (address, line) in listing.items()).encode()
+        return zlib.compress(RECORD_HEADER.pack(len(words), len(values), len(removed), len(text)) +
+                             words.tobytes() + values.tobytes() + removed.tobytes() + text)
+
+    def read(self, name):
+        """ Decodes the record of a checkpoint
+
+        Returns:
+            (array, array, array, dict) : addresses, values, removed entries and changed entries
+        """
+        if name not in self.index:
+            raise KeyError(f"Unknown checkpoint {name}")
+        entry = self.index[name]
+        with open(f"{self.path}.dif", 'rb') as file:
+            file.seek(entry['offset'])
+            body = zlib.decompress(file.read(entry['size']))
+        (*counts, _) = RECORD_HEADER.unpack_from(body)
+        arrays, position = [], RECORD_HEADER.size
+        for count in counts:
+            arrays.append(array('H', body[position:position + 2 * count]))
+            position += 2 * count
+        listing = {}
+        for item in body[position:].decode().split("\0") if position < len(body) else ():
+            (address, line) = item.split(":", 1)
+            listing[int(address)] = line
+        return (*arrays, listing)
+
+    def checkpoint(self, name):
+        """ Memory and listing of a checkpoint, rebuilt from the base
+
+        Args:
+            name (string): name of the checkpoint
+
+        Returns:
+            (array, dict) : memory words and listing entries by address
+        """
+        if self.base is None:
+            (image, _, _, listing) = self.read(self.order[0])
+            self.base = (image, listing)
+        (image, listing) = (array('H', self.base[0]), dict(self.base[1]))
+        if name != self.order[0]:
+            (addresses, values, removed, changed) = self.read(name)
+            for (address, value) in zip(addresses, values):
+                image[address] = value
+            for address in removed:
+                del listing[address]
+            listing.update(changed)
+        return (image, listing)
+
+    def listing(self, name, file=None):
+        """ Writes the full listing of a checkpoint
+        """
+        (_, listing) = self.checkpoint(name)
+        (file or sys.stdout).write("\n".join(listing[address] for address in sorted(listing)) + "\n")
+
+    def diff(self, first, second, file=None):
+        """ Writes the words and the listing lines that differ between two checkpoints
+        """
+        ((image1, listing1), (image2, listing2)) = (self.checkpoint(first), self.checkpoint(second))
+        for address in range(MAX_ADDRESS):
+            if image1[address] != image2[address]:
+                print(f"[{address:<5}] {image1[address]:<5} -> {image2[address]}", file = file)
+        lines1 = [line for address in sorted(listing1) for line in listing1[address].split("\n")]
+        lines2 = [line for address in sorted(listing2) for line in listing2[address].split("\n")]
+        for line in difflib.unified_diff(lines1, lines2, first, second, lineterm="", n=1):
+            print(line, file = file)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rebuilds or compares differential memory dumps")
+    parser.add_argument('--archive', default="checkpoints", help="name of the archive in Dumps")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list', help="lists the checkpoints")
+    rebuild = commands.add_parser('listing', help="prints the full listing of a checkpoint")
+    rebuild.add_argument('name')
+    compare = commands.add_parser('diff', help="prints the differences between two checkpoints")
+    compare.add_argument('first')
+    compare.add_argument('second')
+    arguments = parser.parse_args()
+    archive = DumpArchive(arguments.archive)
+    if arguments.command == 'list':
+        for checkpoint in archive.order:
+            entry = archive.index[checkpoint]
+            print(f"{checkpoint:<25} {entry['words']:>6} words {entry['size']:>8} bytes")
+    elif arguments.command == 'listing':
+        archive.listing(arguments.name)
+    else:
+        archive.diff(arguments.first, arguments.second)
@@ -0,0 +1,279 @@
+""" Module running many instances of the program in lockstep with NumPy
+
+All the lanes share one read-only memory image and each has its own
+registers, stack and cursor. A step groups the lanes by cursor and executes
+each instruction once for all the lanes that are on it, so lanes following
+the same path cost a few NumPy operations per instruction whatever their number.
+Lanes stop on their own: when they reach a stop address or a condition,
+halt, or fault (invalid code, memory write, input, stack overflow).
+"""
+import sys
+import time
+import argparse
+import numpy as np
+from constants import MAX_ADDRESS, ARITY, REGISTER_NAMES
+
+RETURN = MAX_ADDRESS       # return address pushed by call, outside of memory
+INVALID = len(ARITY)
+TARGETS = (1, 3, 4, 5, 9, 10, 11, 12, 13, 14, 15)    # operations writing the register a
+RUNNING, STOPPED, HALTED, FAULTED = range(4)
+OPERATIONS = {
+    4: lambda left, right: left == right,
+    5: lambda left, right: left > right,
+    9: lambda left, right: (left + right) & 32767,
+    10: lambda left, right: (left * right) & 32767,
+    11: lambda left, right: left % right,
+    12: lambda left, right: left & right,
+    13: lambda left, right: left | right,
+}
+REGISTERS = {name: index for (index, name) in enumerate(REGISTER_NAMES)}
+
+
+class BatchVirtualMachine:
+    """ Lanes of a virtual machine sharing one memory image
+
+    Registers are kept as an (8, lanes) array so that a register of every lane
+    is contiguous, stacks as a (lanes, depth) array with a stack pointer per lane.
+
+    Args:
+        image (sequence): memory words, copied (at most MAX_ADDRESS of them)
+        lanes (int): number of instances
+        depth (int, optional): size of each stack. Defaults to 1024.
+    """
+    def __init__(self, image, lanes, depth=1024):
+        self.image = np.zeros(MAX_ADDRESS + 4, dtype=np.int64)
+        words = np.asarray(image[:MAX_ADDRESS], dtype=np.int64)
+        self.image[:len(words)] = words
+        self.lanes = lanes
+        self.indices = np.arange(lanes)
+        self.registers = np.zeros((8, lanes), dtype=np.int64)
+        self.stack = np.zeros((lanes, depth), dtype=np.int64)
+        self.pointer = np.zeros(lanes, dtype=np.int64)
+        self.cursor = np.zeros(lanes, dtype=np.int64)
+        self.status = np.zeros(lanes, dtype=np.int8)
+        self.executed = 0
+        self.steps = 0
+
+    @classmethod
+    def from_virtual_machine(cls, virtual_machine, lanes, depth=1024):
+        """ Lanes all starting from the state of a virtual machine
+
+        Args:
+            virtual_machine (VirtualMachine): machine to copy
+            lanes (int): number of instances
+            depth (int, optional): size of each stack
+
+        Raises:
+            ValueError: if its stack does not fit in depth
+        """
+        batch = cls(virtual_machine.memory.memory, lanes, depth)
+        stack = virtual_machine.stack.stack
+        if len(stack) > depth:
+            raise ValueError(f"A stack of {len(stack)} values does not fit in {depth}")
+        batch.registers[:] = np.asarray(virtual_machine.memory.registers.tolist())[:, None]
+        batch.stack[:, :len(stack)] = np.asarray(stack.tolist(), dtype=np.int64)
+        batch.pointer[:] = len(stack)
+        batch.cursor[:] = virtual_machine.cursor
+        return batch
+
+    def call(self, address):
+        """ Makes every lane call the routine at address, the lanes stop at
+        RETURN when it returns (see run)
+        """
+        (lanes, _) = self.restrict(slice(None), self.pointer < self.stack.shape[1], FAULTED, 0)
+        self.push(lanes, RETURN)
+        self.cursor[lanes] = address
+
+    def value(self, operand, lanes):
+        """ Value of an operand (literal or register) for some lanes
+        """
+        if operand < MAX_ADDRESS:
+            return operand
+        return self.registers[operand - MAX_ADDRESS, lanes]
+
+    def count(self, lanes):
+        """ Number of lanes in a slice (of all the lanes) or an index array
+        """
+        return self.lanes if isinstance(lanes, slice) else len(lanes)
+
+    def restrict(self, lanes, valid, status=FAULTED, *arrays):
+        """ Gives status to the lanes that are not valid
+
+        Args:
+            lanes (slice or ndarray): all the lanes or their indices
+            valid (ndarray): mask over lanes
+            arrays (ndarray or int): values per lane (or scalars) to restrict too
+
+        Returns:
+            tuple : the valid lanes followed by their values in each array
+        """
+        if valid.all():
+            return (lanes, *arrays)
+        lanes = self.indices[lanes]
+        self.status[lanes[~valid]] = status
+        return (lanes[valid], *(array if np.isscalar(array) else array[valid] for array in arrays))
+
+    def push(self, lanes, values):
+        """ Pushes a value per lane (the lanes must have room, see restrict)
+        """
+        rows = self.indices[lanes]
+        self.stack[rows, self.pointer[rows]] = values
+        self.pointer[rows] += 1
+
+    def pop(self, lanes):
+        """ Pops a value per lane (the lanes must have a non empty stack)
+        """
+        rows = self.indices[lanes]
+        self.pointer[rows] -= 1
+        return self.stack[rows, self.pointer[rows]]
+
+    def execute(self, address, lanes):
+        """ Executes the instruction at address for the lanes whose cursor is on it
+
+        Args:
+            address (int): address of the instruction
+            lanes (slice or ndarray): the lanes
+        """
+        opcode = int(self.image[address])
+        if opcode == 0:
+            self.status[lanes] = HALTED
+            return
+        if opcode >= INVALID or opcode in (16, 20):
+            self.status[lanes] = FAULTED     # no input, and the image is shared
+            return
+        (a, b, c) = self.image[address + 1:address + 4].tolist()
+        if any(operand >= MAX_ADDRESS + 8 for operand in (a, b, c)[:ARITY[opcode]]) or \
+                (opcode in TARGETS and a < MAX_ADDRESS):
+            self.status[lanes] = FAULTED
+            return
+        (registers, target, depth) = (self.registers, a - MAX_ADDRESS, self.stack.shape[1])
+        following = address + 1 + ARITY[opcode]
+        if opcode == 1:
+            registers[target, lanes] = self.value(b, lanes)
+        elif opcode == 2:
+            (lanes, value) = self.restrict(lanes, self.pointer[lanes] < depth, FAULTED, self.value(a, lanes))
+            self.push(lanes, value)
+        elif opcode == 3:
+            (lanes,) = self.restrict(lanes, self.pointer[lanes] > 0)
+            registers[target, lanes] = self.pop(lanes)
+        elif opcode in OPERATIONS:
+            if opcode == 11 and c >= MAX_ADDRESS:
+                (lanes,) = self.restrict(lanes, registers[c - MAX_ADDRESS, lanes] != 0)
+            elif opcode == 11 and c == 0:
+                self.status[lanes] = FAULTED
+                return
+            registers[target, lanes] = OPERATIONS[opcode](self.value(b, lanes), self.value(c, lanes))
+        elif opcode == 14:
+            registers[target, lanes] = self.value(b, lanes) ^ 32767
+        elif opcode == 15:
+            registers[target, lanes] = self.image[self.value(b, lanes)]
+        elif opcode == 6:
+            following = self.value(a, lanes)
+        elif opcode in (7, 8):
+            condition = (self.value(a, lanes) != 0) == (opcode == 7)
+            following = np.where(condition, self.value(b, lanes), following)
+        elif opcode == 17:
+            (lanes, called) = self.restrict(lanes, self.pointer[lanes] < depth, FAULTED, self.value(a, lanes))
+            self.push(lanes, following)
+            following = called
+        elif opcode == 18:
+            (lanes,) = self.restrict(lanes, self.pointer[lanes] > 0, HALTED)
+            following = self.pop(lanes)
+        self.cursor[lanes] = following
+        self.executed += self.count(lanes)
+
+    def step(self, lanes):
+        """ Executes one instruction for each of the given running lanes, out
+        is ignored (lanes have no output)
+
+        Lanes are grouped by cursor so that the operands are decoded once per group.
+        """
+        cursor = self.cursor[lanes]
+        first = int(cursor[0])
+        if (cursor == first).all():
+            self.execute(first, lanes)
+        else:
+            lanes = self.indices[lanes]
+            order = np.argsort(cursor.astype(np.uint16), kind='stable')
+            addresses = cursor[order]
+            bounds = np.flatnonzero(addresses[1:] != addresses[:-1]) + 1
+            for (start, end) in zip([0] + bounds.tolist(), bounds.tolist() + [len(order)]):
+                self.execute(int(addresses[start]), lanes[order[start:end]])
+        self.steps += 1
+
+    def run(self, stops=(RETURN,), condition=None, limit=None):
+        """ Runs until every lane is stopped, halted or faulted
+
+        Args:
+            stops (iterable, optional): addresses stopping a lane before it
+                                        executes them. Defaults to RETURN (see call).
+            condition (callable, optional): called with the machine and the
+                running lanes, returns a mask of the lanes to stop
+            limit (int, optional): maximal number of steps
+
+        Returns:
+            ndarray : mask of the stopped lanes
+        """
+        stops = list(stops)
+        while limit is None or limit > 0:
+            lanes = np.flatnonzero(self.status == RUNNING)
+            if len(lanes) == self.lanes:
+                lanes = slice(None)
+            if stops and self.count(lanes):
+                (lanes,) = self.restrict(lanes, ~self.at_stop(lanes, stops), STOPPED)
+            if condition is not None and self.count(lanes):
+                (lanes,) = self.restrict(lanes, ~condition(self, lanes), STOPPED)
+            if not self.count(lanes):
+                break
+            self.step(lanes)
+            limit = None if limit is None else limit - 1
+        return self.status == STOPPED
+
+    def at_stop(self, lanes, stops):
+        """ Mask of the lanes whose cursor is one of the stops
+        """
+        cursor = self.cursor[lanes]
+        return cursor == stops[0] if len(stops) == 1 else np.isin(cursor, stops)
+
+
+def assignment(text):
+    """ Parses "register=value" or "register=start:end" of the command line
+    """
+    (name, _, value) = text.partition("=")
+    if name not in REGISTERS:
+        raise argparse.ArgumentTypeError(f"{name} is not a register")
+    (start, _, end) = value.partition(":")
+    return (REGISTERS[name], int(start), int(end) if end else None)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Calls a routine of the program for many register values at once")
+    parser.add_argument('--program', default="Program/challenge.bin")
+    parser.add_argument('--call', type=int, required=True, help="address of the routine")
+    parser.add_argument('--set', type=assignment, action='append', default=[], metavar="REGISTER=VALUE",
+                        help="value of a register for every lane (repeat)")
+    parser.add_argument('--sweep', type=assignment, required=True, metavar="REGISTER=START:END",
+                        help="register taking a different value in each lane")
+    parser.add_argument('--expect', type=assignment, action='append', default=[], metavar="REGISTER=VALUE",
+                        help="register value to look for when the routine returns (repeat)")
+    parser.add_argument('--depth', type=int, default=1024, help="size of the stacks")
+    parser.add_argument('--limit', type=int, default=None, help="maximal number of steps")
+    arguments = parser.parse_args()
+    (swept, start, end) = arguments.sweep
+    values = np.arange(start, end if end is not None else start + 1)
+    batch = BatchVirtualMachine(np.fromfile(arguments.program, dtype='<u2'), len(values), arguments.depth)
+    for (register, value, _) in arguments.set:
+        batch.registers[register] = value
+    batch.registers[swept] = values
+    batch.call(arguments.call)
+    began = time.perf_counter()
+    returned = batch.run(limit=arguments.limit)
+    elapsed = time.perf_counter() - began
+    for (register, value, _) in arguments.expect:
+        returned &= batch.registers[register] == value
+    print(" ".join(str(value) for value in values[returned]))
+    (executed, status) = (batch.executed, batch.status)
+    print(f"{len(values)} lanes, {int(returned.sum())} found, {int((status == FAULTED).sum())} faulted, "
+          f"{int((status == RUNNING).sum())} still running, {batch.steps} steps, "
+          f"{executed} instructions in {elapsed:.2f}s ({executed / max(elapsed, 1e-9) / 1e6:.1f} M/s)",
+          file = sys.stderr)
@@ -0,0 +1,318 @@
+""" Module measuring the speed of the virtual machine, the dumper and the solvers
+
+Every benchmark is timed several times and the best wall time is kept. The
+results are saved as JSON and compared with a baseline saved the same way:
+the exit code is 1 when a benchmark got slower than the baseline by more
+than the threshold.
+"""
+import io
+import sys
+import json
+import time
+import tempfile
+import argparse
+import platform
+from array import array
+import numpy as np
+import decoder
+from batch import BatchVirtualMachine
+from dumper import Dumper
+from profiler import Profiler
+from constants import MAX_ADDRESS, ARITY
+from virtual_machine import VirtualMachine, ScriptedPlayer
+from Solvers import vault, equation, teleporter
+
+PROGRAM = "Program/challenge.bin"
+MODES = {
+    'jit': {'fast': True, 'jit': True},
+    'decoded': {'fast': True, 'jit': False},
+    'fused': {'fast': True, 'jit': False, 'fuse': True},
+    'interpreter': {'fast': False, 'jit': False},
+}
+BENCHMARKS = {}
+R = [MAX_ADDRESS + index for index in range(8)]
+# body of the loop measuring each operation (rc is never 0 so mod is defined,
+# rh counts the iterations), addresses from LOOP on
+OPCODES = {
+    'set': [1, R[0], R[1]],
+    'push/pop': [2, R[0], 3, R[1]],
+    'eq': [4, R[0], R[1], R[2]],
+    'gt': [5, R[0], R[1], R[2]],
+    'jmp': [6, None],
+    'jf': [8, R[7], 0],
+    'add': [9, R[0], R[1], R[2]],
+    'mult': [10, R[0], R[1], R[2]],
+    'mod': [11, R[0], R[1], R[2]],
+    'and': [12, R[0], R[1], R[2]],
+    'or': [13, R[0], R[1], R[2]],
+    'not': [14, R[0], R[1]],
+    'rmem': [15, R[0], 30000],
+    'wmem': [16, 30000, R[1]],
+    'call/ret': [17, None],
+    'out': [19, 97],
+    'in': [20, R[0]],
+    'noop': [21],
+}
+REPEAT_BODY = 16
+LOOP = 9
+
+
+def benchmark(name):
+    """ Decorator registering a benchmark, called with the number of repeats
+    and returning its results by name
+    """
+    def register(function):
+        BENCHMARKS[name] = function
+        return function
+    return register
+
+def best_time(prepare, run, repeat):
+    """ Best wall time of run over repeat runs, prepare is not timed
+
+    Args:
+        prepare (callable): returns the argument of run
+        run (callable): the timed work
+        repeat (int): number of runs
+
+    Returns:
+        float : seconds
+    """
+    best = None
+    for _ in range(repeat):
+        argument = prepare()
+        start = time.perf_counter()
+        run(argument)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def result(seconds, instructions=None):
+    """ Result of a benchmark, with its speed when the number of executed
+    instructions is known
+    """
+    if instructions is None:
+        return {'seconds': seconds}
+    return {'seconds': seconds, 'instructions': instructions,
+            'instructions_per_second': instructions / seconds if seconds else None}
+
+def synthetic_program(body, iterations):
+    """ Program running body REPEAT_BODY times per iteration of a loop
+
+    A None operand of jmp is replaced by the address following the body, the
+    one of call by the address of a ret after the program.
+
+    Returns:
+        (array, int) : the program and the number of instructions it executes
+    """
+    words = [1, R[7], iterations, 1, R[1], 12345, 1, R[2], 7]
+    for _ in range(REPEAT_BODY):
+        following = len(words) + len(body)
+        words += [following if word is None and body[0] == 6 else word for word in body]
+    words += [9, R[7], R[7], 32767, 7, R[7], LOOP, 0]
+    subroutine = len(words)
+    words = [subroutine if word is None else word for word in words] + [18]
+    operations = [body[position] for position in operation_positions(body)]
+    executed = len(operations) + operations.count(17)
+    return (array('H', words), 3 + iterations * (REPEAT_BODY * executed + 2) + 1)
+
+def operation_positions(body):
+    """ Positions of the operations in a body (skipping their operands)
+    """
+    positions, position = [], 0
+    while position < len(body):
+        positions.append(position)
+        position += 1 + ARITY[body[position]]
+    return positions
+
+def load_words(virtual_machine, words):
+    """ Loads a program given as words, like VirtualMachine.load
+    """
+    virtual_machine.memory.memory[0:len(words)] = words
+    virtual_machine.memory.flush()
+    virtual_machine.origin = None
+
+def game(mode, profile=False):
+    """ Virtual machine playing Solution/solution.txt without a console (the
+    output is kept), with the hacks of Solution/hacks.yml except those writing dumps
+
+    The teleporter value is solved here first if it is not cached, so that
+    the search is never part of a measure.
+    """
+    teleporter.solve(PROGRAM)
+    with open("Solution/solution.txt") as file:
+        commands = [line.rstrip("\n") for line in file if not line.startswith("#")]
+    virtual_machine = VirtualMachine(ScriptedPlayer(commands), **MODES[mode])
+    virtual_machine.load_hacks("Solution/hacks.yml", exclude="self.dumper")
+    virtual_machine.load(PROGRAM)
+    if profile:
+        virtual_machine.profiler = Profiler()
+    return virtual_machine
+
+
+@benchmark('opcodes')
+def opcodes(repeat, iterations=2000):
+    """ One synthetic loop per operation and execution mode
+    """
+    results = {}
+    for (name, body) in OPCODES.items():
+        (words, instructions) = synthetic_program(body, iterations)
+        for mode in MODES:
+            def prepare():
+                line = ["a" * (iterations * REPEAT_BODY)] if name == 'in' else []
+                virtual_machine = VirtualMachine(ScriptedPlayer(line), **MODES[mode])
+                load_words(virtual_machine, words)
+                return virtual_machine
+            seconds = best_time(prepare, lambda virtual_machine: virtual_machine.run(), repeat)
+            results[f"opcodes.{name}.{mode}"] = result(seconds, instructions)
+    return results
+
+@benchmark('game')
+def end_to_end(repeat):
+    """ The whole solution script, headless
+    """
+    counted = game('interpreter', profile=True)
+    counted.run()
+    instructions = counted.profiler.executed
+    results = {}
+    for mode in MODES:
+        seconds = best_time(lambda: game(mode), lambda virtual_machine: virtual_machine.run(), repeat)
+        results[f"game.{mode}"] = result(seconds, instructions)
+    return results
+
+@benchmark('dump')
+def dump(repeat):
+    """ Full memory listing after the game, from a new disassembler, again
+    from the same one and after a word changed (checked against a new analysis)
+    """
+    virtual_machine = game('jit')
+    virtual_machine.run()
+    def write(dumper):
+        dumper.write_code_chunk(0, MAX_ADDRESS - 1, io.StringIO())
+    def prepare_again():
+        dumper = Dumper(virtual_machine.memory, virtual_machine.instructions)
+        write(dumper)
+        return dumper
+    changed = []
+    def prepare_changed():
+        changed.append(prepare_again())
+        virtual_machine.memory.store(1800, 21 if virtual_machine.memory.memory[1800] != 21 else 0)
+        return changed[-1]
+    results = {
+        'dump.cold': result(best_time(lambda: Dumper(virtual_machine.memory, virtual_machine.instructions),
+                                      write, repeat)),
+        'dump.warm': result(best_time(prepare_again, write, repeat)),
+        'dump.refresh': result(best_time(prepare_changed, write, repeat)),
+    }
+    if any(dumper.disassembler.differences() for dumper in changed):
+        raise RuntimeError("a refreshed listing differs from a new analysis")
+    return results
+
+@benchmark('boot')
+def boot(repeat):
+    """ Time to the first prompt, booting from the program and from a boot image
+    """
+    with tempfile.TemporaryDirectory() as cache:
+        def prepare():
+            return VirtualMachine(ScriptedPlayer([]))
+        def play(cache):
+            def run(virtual_machine):
+                virtual_machine.boot(PROGRAM, cache)
+                virtual_machine.run()
+            return run
+        play(cache)(prepare())
+        return {
+            'boot.cold': result(best_time(prepare, play(None), repeat)),
+            'boot.warm': result(best_time(prepare, play(cache), repeat)),
+        }
+
+@benchmark('solvers')
+def solvers(repeat, candidates=64):
+    """ decoder.py, the vault, the monument equation and the teleporter
+    (f for one value of h and for one batch of candidates)
+    """
+    data = np.fromfile(PROGRAM, dtype='<u2')
+    def decode(_):
+        decrypted = decoder.decrypt(data)
+        decoder.split_phrases(decrypted) + decoder.key_phrases(decrypted)
+    grid = vault.parse(["22 - 9 *", "+ 4 - 18", "4 * 11 *", "* 8 - 1"])
+    template = equation.monument()
+    words = array('H')
+    with open(PROGRAM, 'rb') as file:
+        words.frombytes(file.read())
+    function = teleporter.read_function()
+    (a, b, _) = teleporter.find_call_site(words, function['address'])
+    return {
+        'solvers.decoder': result(best_time(lambda: None, decode, repeat)),
+        'solvers.vault': result(best_time(lambda: None, lambda _: vault.solve(grid, 30), repeat)),
+        'solvers.equation': result(best_time(lambda: None, lambda _: equation.solve(template, equation.COINS),
+                                             repeat)),
+        'solvers.teleporter.value': result(best_time(lambda: None, lambda _: teleporter.value(
+            a, b, 25734, function['increment']), repeat)),
+        'solvers.teleporter.batch': result(best_time(lambda: None, lambda _: teleporter.evaluate(
+            list(range(candidates)), a, b, function['increment']), repeat)),
+    }
+
+@benchmark('batch')
+def batch(repeat, lanes=32768):
+    """ The teleporter routine f(1, 5) for every value of h, in lockstep
+    """
+    image = np.fromfile(PROGRAM, dtype='<u2')
+    def prepare():
+        machine = BatchVirtualMachine(image, lanes, depth=64)
+        machine.registers[0:2] = ((1,), (5,))
+        machine.registers[7] = np.arange(lanes)
+        machine.call(6027)
+        return machine
+    counted = prepare()
+    counted.run()
+    return {'batch.teleporter': result(best_time(prepare, lambda machine: machine.run(), repeat),
+                                       counted.executed)}
+
+def compare(results, baseline, threshold):
+    """ Benchmarks slower than in the baseline by more than threshold
+
+    Args:
+        results (dict): results by name
+        baseline (dict): results of the baseline by name
+        threshold (float): allowed slowdown, 0.25 for 25%
+
+    Returns:
+        list : (name, baseline seconds, seconds) of the regressions
+    """
+    return [(name, baseline[name]['seconds'], measure['seconds']) for (name, measure) in results.items()
+            if name in baseline and measure['seconds'] > baseline[name]['seconds'] * (1 + threshold)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measures the virtual machine, the dumper and the solvers")
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS),
+                        help="benchmarks to run")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per benchmark, the best one is kept")
+    parser.add_argument('--output', default="Dumps/benchmark.json")
+    parser.add_argument('--baseline', default="Dumps/benchmark_baseline.json")
+    parser.add_argument('--save-baseline', action='store_true', help="save the results as the baseline")
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help="slowdown failing the comparison (0.25 for 25%%)")
+    arguments = parser.parse_args()
+    results = {}
+    for name in arguments.only:
+        results.update(BENCHMARKS[name](arguments.repeat))
+    report = {'python': platform.python_version(), 'machine': platform.machine(), 'results': results}
+    for path in [arguments.output] + ([arguments.baseline] if arguments.save_baseline else []):
+        with open(path, 'w') as file:
+            json.dump(report, file, indent=2)
+    try:
+        with open(arguments.baseline) as file:
+            baseline = json.load(file)['results']
+    except FileNotFoundError:
+        baseline = {}
+    for (name, measure) in results.items():
+        speed = measure.get('instructions_per_second')
+        reference = baseline.get(name, {}).get('seconds')
+        print(f"{name:<32} {measure['seconds'] * 1000:>10.2f} ms" +
+              (f" {speed / 1e6:>8.2f} M instructions/s" if speed else " " * 25) +
+              (f" {100 * (measure['seconds'] / reference - 1):>+7.1f}%" if reference else ""))
+    regressions = compare(results, baseline, arguments.threshold)
+    for (name, reference, seconds) in regressions:
+        print(f"Regression: {name} {reference * 1000:.2f} ms -> {seconds * 1000:.2f} ms", file = sys.stderr)
+    sys.exit(1 if regressions else 0)
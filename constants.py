@@ -0,0 +1,7 @@
+""" Module holding the constants shared by the virtual machine and its tools"""
+MAX_ADDRESS = 32768
+REGISTER_NAMES = ('ra', 'rb', 'rc', 'rd', 're', 'rf', 'rg', 'rh')
+# number of operands of each operation, by code
+ARITY = (0, 2, 1, 1, 3, 3, 1, 2, 2, 3, 3, 3, 3, 3, 2, 2, 2, 1, 0, 1, 1, 0)
+# opcode of the trace records and history entries of a hooked address (not an operation)
+HOOK = 0xFFFF
@@ -1,10 +1,11 @@
-from array import array
+import argparse
+import numpy as np
 
-data = array('H')
-with open("Program\challenge.bin", "rb") as f:
-    data.frombytes(f.read())
+START = 6068
+END = 30050
+TABLE = 26851
+ALPHABET = np.arange(256)
 
-decrypted = array('H')
 
 def my_char(a):
     try:
@@ -24,63 +25,84 @@ def is_special(result):
     return result in '+-?_!?=\/,;:*.@"&@()[]%<>\''
 
 
-for address in range(6068, 30050):
-    content = data[address]               # [1730 ] rmem ra   ,rb
+# my_char and the heuristic classes of every 16 bits value (only ascii values are characters)
+CHARS = [my_char(a) for a in range(128)]
+VALID = np.zeros(1 << 16, dtype=bool)
+VALID[:128] = [c != '' for c in CHARS]
+SPECIAL = np.ones(1 << 16, dtype=bool)          # is_special('') is True
+SPECIAL[:128] = [is_special(c) for c in CHARS]
+UPPER = np.zeros(1 << 16, dtype=bool)
+UPPER[:128] = [c.isupper() for c in CHARS]
+
+
+def decrypt(data):
+    content = data[START:END].astype(np.int64)
+    address = np.arange(START, END, dtype=np.int64)
     address = (address ** 2) % 32768      # [1735 ] mult rb   ,rb   ,rb
-    aux = content & address               # [2129 ] and  rc   ,ra   ,rb
-    aux = aux ^ 32767                     # [2133 ] not  rc   ,rc
-    content = content | address           # [2136 ] or   ra   ,ra   ,rb
-    content = content & aux               # [2140 ] and  ra   ,ra   ,rc
-    rb = 16724                            # [1741 ] set  rb   ,16724
-    aux = content & rb                    # 2129
-    aux = aux ^ 32767                     # 2133
-    content = content | rb                # 2136
-    content = content & aux               # 2140
-    decrypted.append(content)             # 2144
-
-start = 0
-phrases = ["[6068 ]"]
-while start < 30049-6068:
-    as_char = my_char(decrypted[start])
-    if (as_char != ''):
-        phrases[-1] = phrases[-1] + as_char
-    else:
-        address = start + 6068
-        if (len(phrases) >= 1 and phrases[-1].endswith(' ]')):
-            phrases[-1] = "[" + str(address) + " ]"
+    content = (content ^ address) & 32767  # [2129 ] and, not, or, and  (15 bits xor)
+    content = (content ^ 16724) & 32767    # [1741 ] set  rb   ,16724 then 2129-2140
+    return content                         # 2144
+
+
+def split_phrases(decrypted):
+    # a character extends the current phrase, anything else starts a new one
+    # unless the current phrase is still empty (or looks empty: ends with ' ]')
+    count = END - 1 - START
+    valid = VALID[decrypted[:count]]
+    text = np.where(valid, decrypted[:count], 0).astype(np.uint8).tobytes().decode('ascii')
+    breaks = np.flatnonzero(~valid)
+    phrases = ["[6068 ]"]
+    starts = np.concatenate(([0], breaks + 1))
+    ends = np.concatenate((breaks, [count]))
+    for (index, (first, last)) in enumerate(zip(starts.tolist(), ends.tolist())):
+        if index:
+            header = "[" + str(first - 1 + START) + " ]"
+            if phrases[-1].endswith(' ]'):
+                phrases[-1] = header
+            else:
+                phrases.append(header)
+        phrases[-1] = phrases[-1] + text[first:last]
+    return phrases
+
+
+def find_key(chunk):
+    significant = int(chunk[0]) // 256
+    keys = significant * 256 + ALPHABET
+    matrix = keys[:, None] ^ chunk[None, :]
+    length = len(chunk)
+    heuristic = (~VALID[matrix]).sum(axis=1) / length + \
+        SPECIAL[matrix].sum(axis=1) / length + UPPER[matrix].sum(axis=1) / length
+    best = int(np.argmin(heuristic))
+    if heuristic[best] >= 3.0:
+        return (0, '')
+    row = matrix[best]
+    decoded = np.where(VALID[row], row, 0).astype(np.uint8)
+    return (int(keys[best]), decoded[decoded != 0].tobytes().decode('ascii'))
+
+
+def key_phrases(decrypted):
+    phrases = []
+    start = TABLE - START
+    while start < END - 1 - START:
+        number = int(decrypted[start])
+        chunk = decrypted[start+1: start+number+1]
+        start = start + number + 1
+        if (number > 10):
+            (key, text) = find_key(chunk)
+            phrases.append("[" + str(start + START) + "/" + str(key) +
+                           "/" + str(number) + " ]" + repr(text))
         else:
-            phrases.append("[" + str(address) + " ]")
-    start = start + 1
-
-start = 26851 - 6068
-number = 0
-while start < 30049-6068:
-    number = decrypted[start]
-    chunk = decrypted[start+1: start+number+1]
-    start = start + number + 1
-    if (number > 10):
-        significant = chunk[0] // 256
-        min_value = 3.0
-        min_result = ['']
-        min_key = 0
-        for a in range(0, 256):
-            key = significant * 256 + a
-            result = [my_char(key ^ x) for x in chunk]
-            non_chars = [c for c in result if (c == '')]
-            specials = [c for c in result if is_special(c)]
-            upper = [c for c in result if c.isupper()]
-
-            heuristic = len(non_chars)/len(result) + \
-                len(specials)/len(result) + len(upper)/len(result)
-            if heuristic < min_value:
-                min_value = heuristic
-                min_result = result
-                min_key = key
-        phrases.append("[" + str(start + 6068) + "/" + str(min_key) +
-                       "/" + str(number) + " ]" + repr(''.join(min_result)))
-    else:
-        phrases.append("[" + str(start + 6068) + "/" + str(number) + " ]")
-
-
-with open("Dumps\phrases.txt", "w") as f:
-    f.write('\n'.join(phrases) + '\n')
+            phrases.append("[" + str(start + START) + "/" + str(number) + " ]")
+    return phrases
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Decrypts the strings of the challenge")
+    parser.add_argument('binary', nargs='?', default="Program/challenge.bin")
+    parser.add_argument('--output', default="Dumps/phrases.txt")
+    arguments = parser.parse_args()
+    data = np.fromfile(arguments.binary, dtype='<u2')
+    decrypted = decrypt(data)
+    phrases = split_phrases(decrypted) + key_phrases(decrypted)
+    with open(arguments.output, "w") as f:
+        f.write('\n'.join(phrases) + '\n')
@@ -0,0 +1,486 @@
+""" Module disassembling the memory by following the control flow"""
+import sys
+import json
+from array import array
+from functools import cache
+from heapq import heapify, heappop, heappush
+from itertools import compress
+from collections import defaultdict
+from constants import MAX_ADDRESS, REGISTER_NAMES
+CHUNK_LINES = 8192
+BRANCHES = ('jmp', 'jt', 'jf', 'call')
+TERMINATORS = ('halt', 'jmp', 'ret')
+POINTERS = ('set', 'push', 'wmem')
+
+
+@cache
+def tables():
+    """ Padded text of every operand value and printable character of every
+    word, built once so that listing a line is only lookups and joins
+
+    Returns:
+        (tuple, string) : operand texts and characters indexed by value
+    """
+    operands = tuple(map("{:<5}".format, range(MAX_ADDRESS))) + tuple(map("{:<5}".format, REGISTER_NAMES))
+    characters = "." * 32 + "".join(map(chr, range(32, 127))) + "." * (MAX_ADDRESS + 8 - 127)
+    return (operands, characters)
+
+
+class Disassembler:
+    """ Recursive descent disassembler: only the instructions reachable from
+    the entry points are decoded, everything else is data. It keeps the basic
+    blocks and the cross references.
+
+    The reachable instructions (decoded regardless of overlaps) are the least
+    set holding the start addresses and closed under fall-through, branch
+    targets and plausible indirect targets. When words change, only the
+    instructions reading them and those reachable through them alone are
+    dropped and followed again (see refresh). The listed instructions are then
+    picked among them, the executed ones first and then by address, skipping
+    any overlapping an instruction already picked, so the listing does not
+    depend on the order of the analysis. Only the cached lines whose
+    instruction, data or label changed are formatted again.
+    """
+    def __init__(self, memory, instructions, entries=(0,)):
+        self.memory = memory
+        self.instructions = {code: (name.strip(), size) for (code, (name, size)) in instructions.items()}
+        self.entries = set(entries)
+        self.reachable = {}
+        self.edges = {}
+        self.guesses = {}
+        self.predecessors = defaultdict(set)
+        self.guessed = defaultdict(set)
+        self.plausibles = {}
+        self.changes = set()
+        self.code = {}
+        self.xrefs = defaultdict(set)
+        self.starts = set()
+        self.image = None
+        self.listing = {}
+
+    def decode(self, address):
+        """ Decodes one instruction
+
+        Args:
+            address (int): address of the instruction
+
+        Returns:
+            (string, array) : operation name and raw arguments, None if not an instruction
+        """
+        words = self.memory.memory
+        if not 0 <= address < MAX_ADDRESS or words[address] not in self.instructions:
+            return None
+        (name, size) = self.instructions[words[address]]
+        args = words[address + 1:address + 1 + size]
+        if len(args) < size or address + size >= MAX_ADDRESS or max(args, default=0) >= MAX_ADDRESS + 8:
+            return None
+        return (name, args)
+
+    def analyze(self, starts=None):
+        """ Follows the control flow from the given addresses (the entry points
+        and the addresses decoded by the virtual machine by default), replacing
+        the previous analysis
+
+        Args:
+            starts (iterable, optional): addresses to start from
+        """
+        if starts is None:
+            starts = self.entries | self.executed()
+        for address in list(self.reachable):
+            self.remove(address)
+        self.plausibles.clear()
+        self.listing.clear()
+        self.update([], set(starts))
+
+    def follow(self, work):
+        """ Decodes the instructions reachable from the addresses of the worklist
+
+        The likely targets of the indirect jumps and calls met on the way are
+        guessed: literal operands of set, push and wmem, and the words right
+        after a jmp, ret or halt. They are followed when they look like code.
+
+        Args:
+            work (list): addresses to decode from, consumed
+        """
+        (reachable, predecessors, guessed) = (self.reachable, self.predecessors, self.guessed)
+        while work:
+            address = work.pop()
+            if address in reachable:
+                continue
+            decoded = self.decode(address)
+            if decoded is None:
+                continue
+            (name, args) = decoded
+            following = address + 1 + len(args)
+            successors = [] if name in TERMINATORS else [following]
+            if name in BRANCHES and args[-1] < MAX_ADDRESS:
+                successors.append(args[-1])
+            guess = args[-1] if name in POINTERS else following if name in TERMINATORS else MAX_ADDRESS
+            guesses = (guess,) if guess < MAX_ADDRESS else ()
+            successors += [guess for guess in guesses if self.plausible(guess)]
+            reachable[address] = decoded
+            self.changes.add(address)
+            self.edges[address] = successors = tuple(sorted(set(successors)))
+            self.guesses[address] = guesses
+            for target in successors:
+                predecessors[target].add(address)
+            for guess in guesses:
+                guessed[guess].add(address)
+            work.extend(successors)
+
+    def remove(self, address):
+        """ Drops a reachable instruction and its edges
+        """
+        del self.reachable[address]
+        self.changes.add(address)
+        for target in self.edges.pop(address):
+            self.predecessors[target].discard(address)
+        for guess in self.guesses.pop(address):
+            self.guessed[guess].discard(address)
+
+    def update(self, changed, starts):
+        """ Updates the reachable instructions after the given words changed
+        and the start addresses became starts, then the listed ones
+
+        Instructions reading a changed word are dropped, with the instructions
+        reachable from them, a guess whose plausibility changed or a former
+        start without going through a start. Everything dropped or changed
+        that still has a reachable predecessor (or is a start) is followed again.
+
+        Args:
+            changed (list): addresses of the words changed since the last update
+            starts (set): start addresses
+        """
+        (reachable, predecessors, edges) = (self.reachable, self.predecessors, self.edges)
+        touched = {address for word in changed for address in range(max(word - 3, 0), word + 1)}
+        dropped = {address for word in changed for address in range(max(word - 3, 0), word + 1)
+                   if address in reachable and word < address + 1 + len(reachable[address][1])}
+        seeds = list(dropped) + [address for address in self.starts - starts if address in reachable]
+        if len(changed) > 64:
+            self.plausibles.clear()
+        else:
+            for word in changed:
+                for guess in range(max(word - 4 * 64, 0), word + 1):
+                    self.plausibles.pop(guess, None)
+        candidates = set(starts - self.starts)
+        for guess in {guess for guess in self.guessed if self.guessed[guess]} - self.plausibles.keys():
+            accepted = self.plausible(guess)
+            for source in self.guessed[guess] - dropped:
+                if (guess in edges[source]) == accepted or guess in self.successors(source):
+                    continue
+                edges[source] = tuple(sorted(set(edges[source]) ^ {guess}))
+                if accepted:
+                    predecessors[guess].add(source)
+                    candidates.add(guess)
+                else:
+                    predecessors[guess].discard(source)
+                    seeds.append(guess)
+        doomed = set()
+        while seeds:
+            address = seeds.pop()
+            if address in doomed or address not in reachable or (address in starts and address not in dropped):
+                continue
+            doomed.add(address)
+            seeds.extend(edges[address])
+        for address in doomed:
+            self.remove(address)
+        (starts, self.starts) = (starts ^ self.starts, starts)
+        self.follow([address for address in doomed | touched | candidates
+                     if address not in reachable and (address in self.starts or predecessors.get(address))])
+        self.changes.update(neighbour for address in starts for neighbour in range(address - 3, address + 4))
+        self.pick(changed)
+
+    def successors(self, address):
+        """ Fall-through and branch target of a reachable instruction (the
+        edges that are not guesses)
+        """
+        (name, args) = self.reachable[address]
+        successors = [] if name in TERMINATORS else [address + 1 + len(args)]
+        if name in BRANCHES and args[-1] < MAX_ADDRESS:
+            successors.append(args[-1])
+        return successors
+
+    def pick(self, changed):
+        """ Lists the reachable instructions that do not overlap: the started
+        ones first, then by address. Only the instructions in self.changes and
+        their overlapping neighbours are picked again, updating the cross
+        references and dropping the cached lines that changed.
+
+        Args:
+            changed (list): addresses of the words changed since the last update
+        """
+        (code, reachable, starts, xrefs) = (self.code, self.reachable, self.starts, self.xrefs)
+        for address in changed:
+            self.discard(address, address + 1)
+        self.image = array('H', self.memory.memory[:MAX_ADDRESS])
+        queued = {address for address in self.changes if 0 <= address < MAX_ADDRESS}
+        heap = [(address not in starts, address) for address in queued]
+        heapify(heap)
+        self.changes = set()
+        listed = bool(self.listing)
+        while heap:
+            (priority, address) = heappop(heap)
+            (before, after) = (code.get(address), reachable.get(address))
+            if after is not None and any(
+                    (neighbour not in starts, neighbour) < (priority, address) and
+                    neighbour + 1 + len(code[neighbour][1]) > address
+                    for neighbour in range(max(address - 3, 0), address + 1 + len(after[1]))
+                    if neighbour != address and neighbour in code):
+                after = None
+            if before == after:
+                continue
+            for (name, args) in filter(None, (before, after)):
+                if listed:
+                    self.discard(address, address + 1 + len(args))
+                if name in BRANCHES and args[-1] < MAX_ADDRESS:
+                    xrefs[args[-1]].discard(address)
+            if after is None:
+                del code[address]
+            else:
+                (name, args) = code[address] = after
+                if name in BRANCHES and args[-1] < MAX_ADDRESS:
+                    xrefs[args[-1]].add(address)
+            for neighbour in range(max(address - 3, 0), address + 4):
+                if neighbour in reachable and neighbour not in queued and \
+                        (neighbour not in starts, neighbour) > (priority, address):
+                    queued.add(neighbour)
+                    heappush(heap, (neighbour not in starts, neighbour))
+
+    def executed(self):
+        """ Addresses of the instructions already run by the virtual machine,
+        they cover most targets of the indirect jumps and calls
+        """
+        visited = getattr(self.memory, 'visited', b'')[:MAX_ADDRESS]
+        return set(compress(range(MAX_ADDRESS), visited))
+
+    def plausible(self, address):
+        """ Checks that straight-line code starting at address decodes up to a
+        jump, call, return or halt (cached until one of the 64 instructions
+        after it may have changed)
+
+        Args:
+            address (int): candidate address
+
+        Returns:
+            bool : True if it looks like code
+        """
+        if address in self.plausibles:
+            return self.plausibles[address]
+        (result, cursor) = (False, address)
+        for _ in range(64):
+            decoded = self.decode(cursor)
+            if decoded is None:
+                break
+            (name, args) = decoded
+            if name in BRANCHES or name in TERMINATORS:
+                result = True
+                break
+            cursor += 1 + len(args)
+        self.plausibles[address] = result
+        return result
+
+    def refresh(self):
+        """ Updates the analysis if the memory or the addresses run by the
+        virtual machine changed since the last one
+        """
+        starts = self.entries | self.executed()
+        words = self.memory.memory[:MAX_ADDRESS]
+        if self.image is None:
+            self.analyze(starts)
+            return
+        if starts == self.starts and words == self.image:
+            return
+        changed = [address for page in range(0, MAX_ADDRESS, 256)
+                   if words[page:page + 256] != self.image[page:page + 256]
+                   for address in range(page, page + 256) if words[address] != self.image[address]]
+        self.update(changed, starts)
+
+    def discard(self, start, end):
+        """ Drops the cached lines overlapping start..end and the lines of the
+        instructions jumping to start (their operand may become a label)
+        """
+        for address in range(max(start - 7, 0), end):
+            self.listing.pop(address, None)
+        for source in self.xrefs.get(start, ()):
+            self.listing.pop(source, None)
+
+    def differences(self, start=0, end=MAX_ADDRESS):
+        """ Checks the listing against the one of a new disassembler of the same memory
+
+        Returns:
+            list : addresses of the entries that differ
+        """
+        self.refresh()
+        fresh = Disassembler(self.memory, self.instructions, self.entries)
+        fresh.analyze()
+        (mine, theirs) = (dict(self.records(start, end)), dict(fresh.records(start, end)))
+        return sorted(address for address in mine.keys() | theirs.keys() if mine.get(address) != theirs.get(address))
+
+    def leaders(self):
+        """ First addresses of the basic blocks: the starts, the targets of
+        the listed instructions and the addresses following their branches
+        """
+        leaders = set(self.starts)
+        for (address, (name, args)) in self.code.items():
+            following = address + 1 + len(args)
+            leaders.update(target for target in self.edges[address] if target != following or name in BRANCHES)
+        return leaders
+
+    def blocks(self):
+        """ Basic blocks of the control flow graph
+
+        Returns:
+            dict : leader => (end address, list of successor leaders)
+        """
+        leaders = self.leaders()
+        result = {}
+        for leader in sorted(leaders):
+            address, successors = leader, []
+            while address in self.code:
+                (name, args) = self.code[address]
+                following = address + 1 + len(args)
+                if name in BRANCHES and args[-1] < MAX_ADDRESS:
+                    successors.append(args[-1])
+                if name in TERMINATORS:
+                    break
+                address = following
+                if address in leaders:
+                    successors.append(address)
+                    break
+            if address != leader or leader in self.code:
+                result[leader] = (address, successors)
+        return result
+
+    def label(self, address):
+        """ Label of an address
+        """
+        return f"label_{address}"
+
+    def operand(self, value, target=False):
+        """ Operand as text, jump targets are replaced by their label
+        """
+        if target and value in self.code:
+            return f"{self.label(value):<5}"
+        return tables()[0][value]
+
+    def line(self, address, end):
+        """ Line of the listing at address: one instruction or up to 8 words of
+        data (stopping at code and at multiples of 8)
+
+        Args:
+            address (int): address of the line
+            end (int): end address of the listing
+
+        Returns:
+            (string, int) : the line and the address of the next one
+        """
+        if address in self.listing and self.listing[address][1] <= end:
+            return self.listing[address]
+        (operands, characters) = tables()
+        if address in self.code:
+            (name, args) = self.code[address]
+            text = " ".join(operands[arg] for arg in args[:-1])
+            if args:
+                text = (text + " " if text else "") + self.operand(args[-1], name in BRANCHES)
+            extra = f"  ; {chr(args[0])!r}" if name == 'out' and args[0] < 128 else ""
+            result = (f"[{address:<5}] {name:<4} {text:<25}{extra}".rstrip(), address + 1 + len(args))
+        else:
+            following = address + 1
+            while following < end and following % 8 and following not in self.code:
+                following += 1
+            data = self.memory.memory[address:following]
+            try:
+                (words, text) = (" ".join(map(operands.__getitem__, data)),
+                                 "".join(map(characters.__getitem__, data)))
+            except IndexError:
+                (words, text) = (" ".join(f"{word:<5}" for word in data),
+                                 "".join(characters[word] if word < len(characters) else "." for word in data))
+            result = (f"[{address:<5}] data {words:<47}  ; {text!r}", following)
+            if following == end and end % 8 and end not in self.code:
+                return result
+        self.listing[address] = result
+        return result
+
+    def records(self, start, end):
+        """ Entries of the listing from start to end keyed by address
+
+        Args:
+            start (int): start address
+            end (int): end address
+
+        Yields:
+            (int, string) : address and its text, the line of code or data
+                            preceded by the label line if it has one
+        """
+        address = start
+        while address < end:
+            (line, following) = self.line(address, end)
+            if address in self.code and (self.xrefs.get(address) or address in self.entries):
+                sources = sorted(self.xrefs[address])
+                references = ", ".join(map(str, sources[:8])) + (" ..." if len(sources) > 8 else "")
+                line = f"{self.label(address)}:" + (f"  ; xrefs {references}" if references else "") + "\n" + line
+            yield (address, line)
+            address = following
+
+    def lines(self, start, end):
+        """ Lines of the listing from start to end
+
+        Args:
+            start (int): start address
+            end (int): end address
+
+        Yields:
+            string : lines of code, labels with their cross references and data
+        """
+        for (_, text) in self.records(start, end):
+            yield from text.split("\n")
+
+    def write(self, start, end, file=None):
+        """ Writes the listing from start to end in chunks of CHUNK_LINES lines
+
+        Args:
+            start (int): start address
+            end (int): end address
+            file (TextIOWrapper, optional): file to write to. Defaults to None.
+        """
+        self.refresh()
+        file = file or sys.stdout
+        chunk = []
+        for (_, text) in self.records(start, end):
+            chunk.append(text)
+            if len(chunk) == CHUNK_LINES:
+                file.write("\n".join(chunk) + "\n")
+                chunk.clear()
+        if chunk:
+            file.write("\n".join(chunk) + "\n")
+
+    def write_json(self, start, end, file=None):
+        """ Writes the listing from start to end as JSON lines: one object per
+        instruction (address, op, args, xrefs) or data word range (address, data)
+
+        Args:
+            start (int): start address
+            end (int): end address
+            file (TextIOWrapper, optional): file to write to. Defaults to None.
+        """
+        self.refresh()
+        file = file or sys.stdout
+        chunk = []
+        address = start
+        while address < end:
+            if address in self.code:
+                (name, args) = self.code[address]
+                entry = {'address': address, 'op': name, 'args': list(args)}
+                if self.xrefs.get(address):
+                    entry['xrefs'] = sorted(self.xrefs[address])
+                following = address + 1 + len(args)
+            else:
+                (_, following) = self.line(address, end)
+                entry = {'address': address, 'data': list(self.memory.memory[address:following])}
+            chunk.append(json.dumps(entry, separators=(',', ':')))
+            address = following
+            if len(chunk) == CHUNK_LINES:
+                file.write("\n".join(chunk) + "\n")
+                chunk.clear()
+        if chunk:
+            file.write("\n".join(chunk) + "\n")
@@ -1,5 +1,7 @@
 """ Module in order to dump the whole memory of the program"""
 from array import array
+from disassembler import Disassembler
+from archive import DumpArchive
 
 
 class Dumper:
@@ -8,97 +10,49 @@ class Dumper:
     def __init__(self, memory, instructions):
         self.memory = memory
         self.instructions = instructions
+        self.disassembler = Disassembler(memory, instructions)
+        self.archives = {}
 
-    def write_code_to_file(self, start, end, filename):
+    def write_code_to_file(self, start, end, filename, listing="asm"):
         """ Writes code starting from start to end to a file in Dumps folder
 
         Args:
             start (int): start address
             end (int): end address
             filename (string): filename without extension, it will be created on Dumps folder.
+            listing (string, optional): "asm" for the text listing or "jsonl" for
+                                        one JSON object per line. Defaults to "asm".
         """
-        with open(f"Dumps/{filename}.asm", 'w') as file:
-            self.write_code_chunk(start, end, file)
+        with open(f"Dumps/{filename}.{listing}", 'w', buffering=1 << 20) as file:
+            if listing == "jsonl":
+                self.disassembler.write_json(start, end, file)
+            else:
+                self.write_code_chunk(start, end, file)
 
-    def write_code_chunk(self, start, end, file= None):
-        """ Dumps the whole memory from start to end
-
-        Args:
-            start (int): start address
-            end (int): end address
-            file (TextIOWrapper, optional): file to write to. Defaults to None.
-        """
-        while start < end:
-            (sec_name, is_data) = self.section_name(start)
-            num_args = 0
-            try:
-                if not is_data :
-                    operation_code = self.memory[start]
-                    (line, num_args) = self.read_code(start, operation_code)
-                    print(line.strip(), file = file)
-                else :
-                    print(self.read_data(start, sec_name).strip(), file = file)
-            except IndexError:
-                print(self.read_data(start, "data").strip(), file = file)
-            except KeyError:
-                print(self.read_data(start, "none").strip(), file = file)
-            start = start + 1 + num_args
-
-    def read_data(self, address, sec_name):
-        """ Line of memory data with readable character if possible
-
-        Args:
-            address (int): address of memory content
-            sec_name (string): name of the section
-
-        Returns:
-            string : the line to save to the file 
-        """
-        data = self.memory.memory[address]
-        extra = "  ; " + repr(self.convert_to_char(data))
-        line = self.format_line(address, sec_name, extra, f"{self.memory.code_of(data):<5}")
-        return line
-
-    def read_code(self, address, operation_code):
-        """ Reads one line of code (op + args)
+    def write_checkpoint(self, name, archive="checkpoints"):
+        """ Adds the memory and its listing to an archive in Dumps folder, only
+        the differences with the first checkpoint of the run are stored
 
         Args:
-            address (int): address of operation in memory
-            instruction (string): name of the operation
-
-        Returns:
-            string : line of code
-        """
-        instruction, number_of_args = self.instructions[operation_code]
-        args = self.memory.read(address + 1, number_of_args)
-        extra = "  ; " + repr(self.convert_to_char(args[0])) if instruction == "out" else ""
-        padded_args = " ".join(map(lambda a: f"{self.memory.code_of(a):<5}", args))
-        line = self.format_line(address, instruction, extra, padded_args)
-        return (line, number_of_args)
-
-    def format_line(self, address, op_name, extra, padded_args):
-        """ Formats the line by padding it left
+            name (string): name of the checkpoint
+            archive (string, optional): archive name without extension. Defaults to "checkpoints".
         """
-        return f"[{address:<5}] {op_name:<4} {str(padded_args):<25}{extra}"
+        if archive not in self.archives:
+            self.archives[archive] = DumpArchive(archive)
+            self.archives[archive].clear()
+        self.disassembler.refresh()
+        self.archives[archive].add(name, self.memory.memory, self.disassembler.records(0, 32767))
 
-    def section_name(self, address):
-        """ Returns the section name in the code.
+    def write_code_chunk(self, start, end, file= None):
+        """ Dumps the whole memory from start to end, only the code reachable
+        from the entry point (or already executed) is disassembled
 
         Args:
-            start (int): address in memory
-
-        Returns:
-            (string, bool): section name and whether it is definitely a data section
+            start (int): start address
+            end (int): end address
+            file (TextIOWrapper, optional): file to write to. Defaults to None.
         """
-        if 843 <= address < 845:
-            return ("sec1", True)
-        if 2317 <= address < 2734:
-            return ("sec2", True)
-        if 3945 <= address < 3958:
-            return ("sec3", True)
-        if 6068 <= address:
-            return ("sec4", True)
-        return ("", False)
+        self.disassembler.write(start, end, file)
 
     def write_memory_chunk(self, start, length):
         """ Prints to stdout the code starting at start with given length
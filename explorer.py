@@ -0,0 +1,195 @@
+""" Module exploring the game by breadth first search over forked virtual machines"""
+import re
+import sys
+import json
+import hashlib
+import argparse
+import multiprocessing
+from collections import OrderedDict
+from virtual_machine import VirtualMachine, ScriptedPlayer
+
+ROOM_ADDRESS = 2732
+STATE_REGIONS = ((843, 845), (2317, 2734), (3945, 3958))
+EXITS = re.compile(r"There (?:are \d+ exits|is 1 exit):\n((?:- .*\n)*)")
+ITEMS = re.compile(r"Things of interest here:\n((?:- .*\n)*)")
+INVENTORY = re.compile(r"Your inventory:\n((?:- .*\n)*)")
+ROOM = re.compile(r"== (.+) ==")
+
+
+def listed(pattern, output):
+    """ Items of the last "- item" list following the pattern
+
+    Args:
+        pattern (Pattern): regular expression capturing the list
+        output (string): output of the game
+
+    Returns:
+        list : the items
+    """
+    matches = pattern.findall(output)
+    if not matches:
+        return []
+    return [line[2:] for line in matches[-1].splitlines()]
+
+
+class Expander:
+    """ Replays command scripts on a private virtual machine, keeping the
+    forks of recent scripts so that siblings only play their last command
+    """
+    def __init__(self, program, cache_size=4096):
+        virtual_machine = VirtualMachine(ScriptedPlayer([]))
+        virtual_machine.load(program)
+        virtual_machine.run()
+        self.virtual_machine = virtual_machine
+        self.root = (virtual_machine.fork(), "")
+        self.forks = OrderedDict()
+        self.cache_size = cache_size
+
+    def state(self, script):
+        """ Fork reached by playing the script from the first prompt
+
+        Args:
+            script (tuple): commands to play
+
+        Returns:
+            (VirtualMachineFork, string) : the state and the output of the last
+                                           command, None if the game ended on the way
+        """
+        if not script:
+            return self.root
+        if script in self.forks:
+            self.forks.move_to_end(script)
+            return self.forks[script]
+        parent = self.state(script[:-1])
+        if parent is None:
+            return None
+        (fork, output, waiting) = self.virtual_machine.branch(parent[0], [script[-1]])
+        state = (fork, output) if waiting else None
+        self.forks[script] = state
+        if len(self.forks) > self.cache_size:
+            self.forks.popitem(last=False)
+        return state
+
+    def describe(self, script):
+        """ Plays the script then looks around (unless it just moved) and at the inventory
+
+        Args:
+            script (tuple): commands to play
+
+        Returns:
+            dict : state key, room address and name, items, exits and inventory,
+                   None if the game ended
+        """
+        state = self.state(script)
+        if state is None:
+            return None
+        (fork, surroundings) = state
+        memory = fork.memory()
+        key = hashlib.blake2b(b''.join(memory[start:end].tobytes()
+                                       for (start, end) in STATE_REGIONS)).hexdigest()
+        if not script or not script[-1].startswith("go "):
+            (_, surroundings, _) = self.virtual_machine.branch(fork, ["look"])
+        (_, inventory, _) = self.virtual_machine.branch(fork, ["inv"])
+        names = ROOM.findall(surroundings)
+        return {
+            'script': script,
+            'key': key,
+            'room': memory[ROOM_ADDRESS],
+            'name': names[-1] if names else "",
+            'items': listed(ITEMS, surroundings),
+            'exits': listed(EXITS, surroundings),
+            'inventory': listed(INVENTORY, inventory),
+        }
+
+
+EXPANDER = None
+
+def start_worker(program):
+    """ Pool initializer creating the expander of the worker process
+    """
+    global EXPANDER
+    EXPANDER = Expander(program)
+
+def describe(script):
+    """ Pool task describing the state reached by a script
+    """
+    return EXPANDER.describe(script)
+
+def commands(state):
+    """ Commands worth trying from a state
+
+    Args:
+        state (dict): state returned by describe
+
+    Returns:
+        list : the commands
+    """
+    return [f"go {name}" for name in state['exits']] + \
+        [f"take {name}" for name in state['items']] + \
+        [f"use {name}" for name in state['inventory']]
+
+def explore(program, processes=None, max_depth=100, max_states=5000):
+    """ Breadth first search over the commands of the game
+
+    Args:
+        program (string): path to the program
+        processes (int, optional): number of worker processes. Defaults to the number of cores.
+        max_depth (int, optional): maximal number of commands in a script.
+        max_states (int, optional): maximal number of distinct states to visit.
+
+    Returns:
+        (dict, int) : rooms keyed by address (name, items, exits leading to other
+                      rooms and the shortest script reaching it) and the number of states
+    """
+    with multiprocessing.Pool(processes, initializer=start_worker, initargs=(program,)) as pool:
+        root = pool.apply(describe, ((),))
+        seen = {root['key']}
+        rooms = {}
+        frontier = [root]
+        for _ in range(max_depth):
+            parents = {}
+            for state in frontier:
+                parents[state['script']] = state
+                room = rooms.setdefault(state['room'], {
+                    'name': state['name'], 'items': state['items'], 'exits': {},
+                    'script': list(state['script'])})
+                room['items'] = sorted(set(room['items']) | set(state['items']))
+            tasks = [state['script'] + (command,) for state in frontier for command in commands(state)]
+            frontier = []
+            for state in pool.imap(describe, tasks, chunksize=16):
+                if state is None or state['key'] in seen or len(seen) >= max_states:
+                    continue
+                seen.add(state['key'])
+                frontier.append(state)
+                command = state['script'][-1]
+                parent = parents[state['script'][:-1]]
+                if command.startswith("go ") and state['room'] != parent['room']:
+                    rooms[parent['room']]['exits'].setdefault(command[3:], state['room'])
+            if not frontier:
+                break
+    return rooms, len(seen)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Explores the game by breadth first search")
+    parser.add_argument('--program', default="Program/challenge.bin")
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--max-depth', type=int, default=100)
+    parser.add_argument('--max-states', type=int, default=5000)
+    parser.add_argument('--output', help="file to save the room graph to (json)")
+    parser.add_argument('--target', help="prints the shortest script reaching this room")
+    arguments = parser.parse_args()
+    (explored, states) = explore(arguments.program, arguments.processes,
+                                 arguments.max_depth, arguments.max_states)
+    if arguments.output:
+        with open(arguments.output, 'w') as file:
+            json.dump(explored, file, indent=2)
+    if arguments.target:
+        reached = [room for room in explored.values() if room['name'] == arguments.target]
+        if not reached:
+            sys.exit(f"Room {arguments.target!r} not reached")
+        print("\n".join(min(reached, key=lambda room: len(room['script']))['script']))
+    else:
+        for (address, room) in sorted(explored.items(), key=lambda item: len(item[1]['script'])):
+            print(f"[{address:<5}] {room['name']:<25} {len(room['script']):>3} : {', '.join(room['script'])}")
+        print(f"{len(explored)} rooms, {states} states")
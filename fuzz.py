@@ -0,0 +1,110 @@
+""" Module checking the fast execution modes against the interpreter
+
+Random self-modifying programs (wmem into their own code, rmem of their own
+operands, jumps anywhere in the program) are run by the interpreter and by
+every other mode, and the final states must be the same. Only the programs
+the interpreter halts within the step limit are compared: a fast mode runs
+at most as many steps (a step is an instruction or a whole block), so a
+faithful one halts too. The exit code is 1 when a mode diverged.
+"""
+import sys
+import random
+import argparse
+from array import array
+from benchmark import MODES, load_words
+from constants import MAX_ADDRESS
+from virtual_machine import VirtualMachine, ScriptedPlayer, RuntimeException
+
+REGISTERS = [MAX_ADDRESS + index for index in range(8)]
+# operations generated, in (halt excluded: memory after the program is zeros)
+OPERATIONS = [code for code in range(1, 22) if code != 20]
+# operations whose first operand is the register written
+WRITING = (1, 3, 4, 5, 9, 10, 11, 12, 13, 14, 15)
+
+
+def program(generator, length):
+    """ Random program of about length words. Literal operands are addresses
+    of its instructions or small numbers (valid operation codes), registers
+    are first set to such addresses and the stack is filled with them, so that
+    rmem, wmem, jumps and returns mostly stay on its instructions
+
+    Args:
+        generator (Random): random generator
+        length (int): size of the random part
+
+    Returns:
+        list : the words of the program
+    """
+    instructions = VirtualMachine(ScriptedPlayer([])).instructions
+    (words, starts, prologue) = ([], [], 8 * 3 + 16 * 2)
+    while len(words) < length:
+        starts.append(prologue + len(words))
+        code = generator.choice(OPERATIONS)
+        words.append(code)
+        words += [None] * instructions[code][1]
+    def literal():
+        return generator.choice(starts) if generator.random() < 0.7 else generator.randrange(22)
+    for (position, word) in enumerate(words):
+        if word is None:
+            target = prologue + position - 1 in starts and words[position - 1] in WRITING
+            words[position] = generator.choice(REGISTERS) if target or generator.random() < 0.4 else literal()
+    setup = []
+    for register in REGISTERS:
+        setup += [1, register, generator.choice(starts)]
+    for _ in range(16):
+        setup += [2, generator.choice(starts)]
+    return setup + words
+
+def state(virtual_machine, outcome):
+    """ Everything a mode must reproduce
+    """
+    return (outcome, bytes(virtual_machine.memory.memory), list(virtual_machine.stack.stack),
+            virtual_machine.player.text())
+
+def play(words, mode, limit):
+    """ Runs a program in one mode
+
+    Returns:
+        tuple : the final state (see state), the outcome is "halted", "quantum" or the error
+    """
+    virtual_machine = VirtualMachine(ScriptedPlayer([]), **MODES[mode])
+    load_words(virtual_machine, array('H', words))
+    try:
+        outcome = virtual_machine.run_for(limit)
+    except (RuntimeException, ArithmeticError, IndexError) as error:
+        outcome = type(error).__name__
+    return state(virtual_machine, outcome)
+
+def check(seed, modes, length=48, limit=2000):
+    """ Modes diverging from the interpreter on the program of a seed
+
+    Returns:
+        list : names of the diverging modes, None if the interpreter does not halt
+    """
+    words = program(random.Random(seed), length)
+    expected = play(words, 'interpreter', limit)
+    if expected[0] != "halted":
+        return None
+    return [mode for mode in modes if play(words, mode, limit) != expected]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compares the fast modes with the interpreter on random programs")
+    parser.add_argument('--programs', type=int, default=2000, help="number of random programs")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the first program")
+    parser.add_argument('--modes', nargs='+', default=[mode for mode in MODES if mode != 'interpreter'],
+                        choices=[mode for mode in MODES if mode != 'interpreter'])
+    arguments = parser.parse_args()
+    (compared, diverged) = (0, {})
+    for seed in range(arguments.seed, arguments.seed + arguments.programs):
+        modes = check(seed, arguments.modes)
+        if modes is None:
+            continue
+        compared += 1
+        for mode in modes:
+            diverged.setdefault(mode, []).append(seed)
+    print(f"{compared} halting programs out of {arguments.programs}")
+    for mode in arguments.modes:
+        seeds = diverged.get(mode, [])
+        print(f"{mode:<12} {len(seeds):>6} diverged" + (f" (seeds {seeds[:8]})" if seeds else ""))
+    sys.exit(1 if diverged else 0)
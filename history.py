@@ -0,0 +1,82 @@
+""" Module keeping the history of the virtual machine to execute it backwards"""
+from array import array
+from collections import deque
+from constants import HOOK
+
+ENTRY_WORDS = 6    # cursor, opcode, target, old value, stack top (character read by in), call stack top
+
+
+class HistorySegment:
+    """ Instructions executed from a fork: the state at the start and one undo
+    entry per instruction
+    """
+    def __init__(self, fork, start):
+        self.fork = fork
+        self.start = start
+        self.log = array('H')
+        self.forks = []
+
+    @property
+    def end(self):
+        """ Instruction number following the last entry
+        """
+        return self.start + len(self.log) // ENTRY_WORDS
+
+
+class ExecutionHistory:
+    """ Undo log filled by VirtualMachine.run_recorded, read by step_back and
+    run_back_to
+
+    Every interval instructions the state is forked (forks share the pages
+    that did not change) and a new segment starts, only the last depth
+    segments are kept so the history holds at most interval * depth
+    instructions. Hacks may change anything, the state is forked before each
+    hooked address instead of logging it.
+    """
+    def __init__(self, interval=1 << 16, depth=16):
+        self.interval = interval
+        self.depth = depth
+        self.segments = deque()
+
+    @property
+    def count(self):
+        """ Number of instructions executed since the recording started
+        """
+        return self.segments[-1].end if self.segments else 0
+
+    @property
+    def start(self):
+        """ Number of the oldest instruction that can be undone
+        """
+        return self.segments[0].start if self.segments else 0
+
+    def due(self):
+        """ Whether the current segment is full (or missing)
+        """
+        return not self.segments or len(self.segments[-1].log) >= self.interval * ENTRY_WORDS
+
+    def checkpoint(self, fork):
+        """ Starts a new segment, dropping the oldest one beyond depth
+
+        Args:
+            fork (VirtualMachineFork): current state
+
+        Returns:
+            HistorySegment : the new segment
+        """
+        self.segments.append(HistorySegment(fork, self.count))
+        if len(self.segments) > self.depth:
+            self.segments.popleft()
+        return self.segments[-1]
+
+    def last_visit(self, address):
+        """ Number of the last instruction executed at address
+
+        Returns:
+            int : the instruction number, None if it is not in the history
+        """
+        for segment in reversed(self.segments):
+            cursors = segment.log[::ENTRY_WORDS].tolist()
+            if address in cursors:
+                return segment.start + len(cursors) - 1 - cursors[::-1].index(address)
+        return None
@@ -0,0 +1,59 @@
+""" Module implementing routines of the program in Python
+
+A native is called with the virtual machine when the program calls the
+routine: it reads and writes registers, stack and memory like the routine
+would, VirtualMachine.bind then returns as if ret had executed.
+"""
+from array import array
+from constants import MAX_ADDRESS
+from Solvers.teleporter import value as teleporter_value
+
+NATIVES = {}
+
+
+class Native:
+    """ Python implementation of the routine at address with the register
+    values (dict register => value) it is validated on
+    """
+    def __init__(self, address, function, samples=()):
+        self.address = address
+        self.function = function
+        self.samples = samples
+
+
+def native(address, samples=({},)):
+    """ Decorator registering a native for the routine at address
+    """
+    def register(function):
+        NATIVES[address] = Native(address, function, samples)
+        return function
+    return register
+
+
+@native(2125, samples=({0: 0, 1: 0}, {0: 12345, 1: 6789}, {0: 32767, 1: 1}, {0: 5, 1: 16724}))
+def exclusive_or(virtual_machine):
+    """ [2125] ra = ra xor rb (computed with and, not and or)
+    """
+    registers = virtual_machine.memory.registers
+    registers[0] = (registers[0] ^ registers[1]) & 32767
+
+@native(1723)
+def decrypt(virtual_machine):
+    """ [1723] decrypts 6068 to 30050 in place: word xor address**2 xor 16724
+    """
+    memory = virtual_machine.memory
+    words = memory.memory[6068:30050]
+    decrypted = array('H', ((word ^ (address * address % MAX_ADDRESS) ^ 16724) & 32767
+                            for (address, word) in zip(range(6068, 30050), words)))
+    for (address, word) in zip(range(6068, 30050), decrypted):
+        if memory.memory[address] != word:
+            memory.store(address, word)
+
+@native(6027, samples=({0: 0, 1: 9, 7: 3}, {0: 2, 1: 3, 7: 5}, {0: 3, 1: 2, 7: 1}, {0: 1, 1: 0, 7: 32767}))
+def teleporter(virtual_machine):
+    """ [6027] ra = f(ra, rb) of the teleporter check with h = rh, rb is left
+    at ra - 1 by the last call of the recursion
+    """
+    registers = virtual_machine.memory.registers
+    registers[0] = teleporter_value(registers[0], registers[1], registers[7])
+    registers[1] = (registers[0] + MAX_ADDRESS - 1) % MAX_ADDRESS
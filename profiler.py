@@ -0,0 +1,92 @@
+""" Module profiling the instructions executed by the virtual machine"""
+from array import array
+from collections import Counter
+from constants import MAX_ADDRESS
+
+
+class Profiler:
+    """ Execution counts per address, call graph edges and inclusive counts per
+    function, filled by VirtualMachine.run_profiled
+    """
+    def __init__(self, size=MAX_ADDRESS + 8):
+        self.counts = array('Q', bytes(8 * size))
+        self.edges = Counter()
+        self.calls = Counter()
+        self.inclusive = Counter()
+        self.frames = []
+        self.active = Counter()
+        self.executed = 0
+
+    def enter(self, caller, callee, executed):
+        """ Records a call
+
+        Args:
+            caller (int): address of the calling function (0 for the entry point)
+            callee (int): address of the called function
+            executed (int): number of instructions executed so far
+        """
+        self.edges[(caller, callee)] += 1
+        self.calls[callee] += 1
+        self.active[callee] += 1
+        self.frames.append((callee, executed))
+
+    def leave(self, executed):
+        """ Records a return, the instructions of recursive calls are only
+        counted once for the outermost call
+
+        Args:
+            executed (int): number of instructions executed so far
+        """
+        if not self.frames:
+            return
+        (function, start) = self.frames.pop()
+        self.active[function] -= 1
+        if not self.active[function]:
+            self.inclusive[function] += executed - start
+
+    def opcodes(self, memory, instructions):
+        """ Execution counts per operation
+
+        Args:
+            memory (VirtualMachineMemory): memory of the virtual machine
+            instructions (dict): operations of the virtual machine by code
+
+        Returns:
+            Counter : count per operation name
+        """
+        result = Counter()
+        for (address, count) in enumerate(self.counts):
+            if count:
+                name = instructions.get(memory.memory[address], ('????', 0))[0]
+                result[name.strip()] += count
+        return result
+
+    def report(self, virtual_machine, file=None, top=50):
+        """ Prints the hottest addresses (disassembled with the listing of the
+        dumper), operations, functions and call edges
+
+        Args:
+            virtual_machine (VirtualMachine): the profiled virtual machine
+            file (TextIOWrapper, optional): file to write to. Defaults to None.
+            top (int, optional): number of lines per section. Defaults to 50.
+        """
+        (memory, disassembler) = (virtual_machine.memory, virtual_machine.dumper.disassembler)
+        disassembler.refresh()
+        total = self.executed or 1
+        print(f"{self.executed} instructions", file = file)
+        print("\n; hottest addresses", file = file)
+        hottest = sorted(((count, address) for (address, count) in enumerate(self.counts) if count),
+                         reverse=True)[:top]
+        for (count, address) in hottest:
+            (line, _) = disassembler.line(address, MAX_ADDRESS)
+            print(f"{count:>12} {100 * count / total:6.2f}%  {line.strip()}", file = file)
+        print("\n; operations", file = file)
+        for (name, count) in self.opcodes(memory, virtual_machine.instructions).most_common():
+            print(f"{count:>12} {100 * count / total:6.2f}%  {name}", file = file)
+        print("\n; functions (inclusive)", file = file)
+        for (function, count) in self.inclusive.most_common(top):
+            print(f"{count:>12} {100 * count / total:6.2f}%  [{function:<5}] "
+                  f"called {self.calls[function]} times", file = file)
+        print("\n; call edges", file = file)
+        for ((caller, callee), count) in self.edges.most_common(top):
+            print(f"{count:>12}  [{caller:<5}] -> [{callee:<5}]", file = file)
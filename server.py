@@ -0,0 +1,232 @@
+""" Module serving game sessions over TCP or a Unix socket with asyncio
+
+Every connection plays its own game: the lines it sends are the commands
+and it receives the output of the game. Sessions start from a fork of a
+machine booted once, take turns running quantum steps each (round robin)
+and are only scheduled while they have input to process. The output of a
+turn is sent at once, and a session whose client reads too slowly waits for
+its output to drain before running again. Sending "!stats" returns the CPU
+time of the session (in order with the output of the commands sent before).
+A session ends when the game halts, or once its client has closed its side
+of the connection and every command it sent has been played.
+"""
+import sys
+import time
+import asyncio
+import argparse
+from collections import deque
+from virtual_machine import VirtualMachine, ScriptedPlayer
+
+QUANTUM = 2000
+HIGH_WATER = 1 << 16
+BACKLOG = 1024
+
+
+class SessionPlayer(ScriptedPlayer):
+    """ Player of a session, answering "!stats" when the game reads it
+
+    Args:
+        statistics (callable): returns the text answering "!stats"
+    """
+    def __init__(self, statistics):
+        super().__init__([])
+        self.statistics = statistics
+
+    def read_line(self):
+        """ Returns the next command, writing the statistics for "!stats"
+
+        Raises:
+            WaitingForInput: once every command has been read
+        """
+        line = super().read_line()
+        while line == "!stats\n":
+            self.write(self.statistics() + "\n")
+            line = super().read_line()
+        return line
+
+
+class Session:
+    """ One game played over a connection
+
+    Args:
+        number (int): number of the session
+        virtual_machine (VirtualMachine): machine of the session (with a SessionPlayer)
+        writer (StreamWriter): connection to the client
+    """
+    def __init__(self, number, virtual_machine, writer):
+        self.number = number
+        self.virtual_machine = virtual_machine
+        self.writer = writer
+        self.waiting = True
+        self.ended = False
+        self.closed = False
+        self.cpu = 0.0
+        self.slices = 0
+
+    def feed(self, line):
+        """ Queues a command
+
+        Returns:
+            bool : True if the session was waiting for it (it has to be scheduled)
+        """
+        self.virtual_machine.player.commands.append(line)
+        (waiting, self.waiting) = (self.waiting, False)
+        return waiting
+
+    def run(self, quantum):
+        """ Runs one turn and accounts its CPU time
+
+        Returns:
+            string : state returned by VirtualMachine.run_for
+        """
+        start = time.thread_time()
+        state = self.virtual_machine.run_for(quantum)
+        self.cpu += time.thread_time() - start
+        self.slices += 1
+        self.waiting = state == "input"
+        return state
+
+    def send(self, text=None):
+        """ Sends text, or the output of the game since the last call
+        """
+        output = self.virtual_machine.player.output
+        if text is None:
+            (text, output[:]) = ("".join(output), [])
+        if text and not self.closed:
+            self.writer.write(text.encode())
+
+    def close(self):
+        """ Closes the connection
+        """
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+
+    def stats(self):
+        """ Description of the resources used so far
+        """
+        return f"session {self.number}: {self.slices} turns, {self.cpu:.3f}s CPU"
+
+
+class SessionServer:
+    """ Hosts the sessions and schedules them
+
+    Args:
+        program (string, optional): path to the program
+        quantum (int, optional): steps per turn (see VirtualMachine.run_for)
+        fast (bool, optional): use the decoded instructions. Defaults to True.
+        jit (bool, optional): compile blocks. Defaults to True.
+    """
+    def __init__(self, program="Program/challenge.bin", quantum=QUANTUM, fast=True, jit=True):
+        self.quantum = quantum
+        self.fast = fast
+        self.jit = jit
+        self.ready = deque()
+        self.wakeup = asyncio.Event()
+        self.sessions = {}
+        self.count = 0
+        booted = VirtualMachine(ScriptedPlayer([]), fast, jit)
+        booted.boot(program)
+        booted.run()
+        (self.origin, self.greeting) = (booted.fork(), booted.player.text())
+
+    def schedule(self, session):
+        """ Makes a session runnable
+        """
+        self.ready.append(session)
+        self.wakeup.set()
+
+    async def scheduler(self):
+        """ Runs the ready sessions one turn each, in turn, a session failing
+        is finished without stopping the others
+        """
+        while True:
+            if not self.ready:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            session = self.ready.popleft()
+            if session.closed:
+                continue
+            try:
+                state = session.run(self.quantum)
+            except Exception as error:    # pylint: disable=broad-except
+                print(f"session {session.number} failed: {error!r}", file = sys.stderr)
+                state = "halted"
+            session.send()
+            if state == "halted" or (state == "input" and session.ended):
+                self.finish(session)
+            elif state == "quantum":
+                if session.writer.transport.get_write_buffer_size() > HIGH_WATER:
+                    asyncio.create_task(self.drain(session))
+                else:
+                    self.ready.append(session)
+            await asyncio.sleep(0)
+
+    async def drain(self, session):
+        """ Schedules a session again once its client has read its output
+        """
+        try:
+            await session.writer.drain()
+        except ConnectionError:
+            self.finish(session)
+            return
+        self.schedule(session)
+
+    async def handle(self, reader, writer):
+        """ Plays a session for a new connection
+        """
+        self.count += 1
+        virtual_machine = VirtualMachine(None, self.fast, self.jit)
+        session = Session(self.count, virtual_machine, writer)
+        virtual_machine.player = SessionPlayer(session.stats)
+        virtual_machine.resume(self.origin)
+        self.sessions[session.number] = session
+        session.send(self.greeting)
+        try:
+            async for line in reader:
+                if session.feed(line.decode(errors='replace').rstrip("\r\n")):
+                    self.schedule(session)
+        except ConnectionError:
+            self.finish(session)
+            return
+        session.ended = True
+        if session.waiting:
+            self.finish(session)
+
+    def finish(self, session):
+        """ Closes a session and reports what it used
+        """
+        if self.sessions.pop(session.number, None) is not None:
+            session.close()
+            print(session.stats(), file = sys.stderr)
+
+    async def serve(self, host="127.0.0.1", port=8023, path=None):
+        """ Accepts connections on a TCP port, or on a Unix socket if path is given
+        """
+        if path:
+            server = await asyncio.start_unix_server(self.handle, path, backlog=BACKLOG)
+        else:
+            server = await asyncio.start_server(self.handle, host, port, backlog=BACKLOG)
+        scheduler = asyncio.create_task(self.scheduler())
+        async with server:
+            try:
+                await server.serve_forever()
+            finally:
+                scheduler.cancel()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serves game sessions, one per connection")
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8023)
+    parser.add_argument('--unix', metavar='PATH', help="listen on a Unix socket instead of TCP")
+    parser.add_argument('--quantum', type=int, default=QUANTUM, help="steps per turn")
+    parser.add_argument('--program', default="Program/challenge.bin")
+    parser.add_argument('--no-jit', action='store_true', help="only use the pre-decoded instruction cache")
+    arguments = parser.parse_args()
+    session_server = SessionServer(arguments.program, arguments.quantum, jit=not arguments.no_jit)
+    try:
+        asyncio.run(session_server.serve(arguments.host, arguments.port, arguments.unix))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,265 @@
+""" Module fusing recurring instruction sequences into superinstructions
+
+A superinstruction replaces the decoded closure of the first instruction of a
+sequence (see VirtualMachine.decode) and executes the whole sequence in one
+dispatch. It leaves registers, stacks and memory exactly as the sequence would,
+so the state is the same as without fusion whenever the cursor is between two
+sequences, and a sequence never goes over a hooked address. When the fused
+code cannot run (stack too short...) the first instruction runs alone, as its
+plain closure would.
+"""
+import operator
+from collections import Counter
+from operator import itemgetter
+from constants import MAX_ADDRESS
+
+MAX_SEQUENCE = 8
+ENDS = ('jmp', 'jt', 'jf', 'call', 'ret', 'halt', 'in')
+PATTERNS = {}
+# operations whose result is often tested right away (reduced modulo 2^15)
+TESTED = {
+    'eq': operator.eq,
+    'gt': operator.gt,
+    'add': operator.add,
+    'mult': operator.mul,
+    'and': operator.and_,
+    'or': operator.or_,
+}
+
+
+def pattern(name):
+    """ Decorator registering a pattern, called with the virtual machine, the
+    sequence at the address (see Superinstructions.sequence), the plain closure
+    of its first instruction and the counter of the address (fires, address)
+
+    The pattern returns (label, step, end): the name of the fused sequence, a
+    closure running it and the address following it, or None if it does not match.
+    """
+    def register(function):
+        PATTERNS[name] = function
+        return function
+    return register
+
+
+class Superinstructions:
+    """ Fuses sequences for VirtualMachine.decode and counts how often each
+    fused sequence runs (fires, by address of its first instruction)
+
+    Args:
+        patterns (iterable, optional): names of the patterns to use. Defaults to all of them.
+    """
+    def __init__(self, patterns=None):
+        self.patterns = [PATTERNS[name] for name in (PATTERNS if patterns is None else patterns)]
+        self.fires = [0] * MAX_ADDRESS
+        self.sites = {}
+
+    def sequence(self, virtual_machine, address):
+        """ Instructions following address that may be fused: up to the first
+        hooked address (after address), jump, in or invalid instruction
+
+        Returns:
+            list : (name, args, following) of each instruction
+        """
+        (words, instructions, cursor) = (virtual_machine.memory.memory, [], address)
+        while len(instructions) < MAX_SEQUENCE and cursor < MAX_ADDRESS:
+            if cursor != address and virtual_machine.hooked[cursor]:
+                break
+            (name, arity) = virtual_machine.instructions.get(words[cursor], (None, 0))
+            args = words[cursor + 1:cursor + 1 + arity]
+            if name is None or len(args) < arity or any(arg >= MAX_ADDRESS + 8 for arg in args):
+                break
+            cursor += 1 + arity
+            instructions.append((name.strip(), args, cursor))
+            if name.strip() in ENDS:
+                break
+        return instructions
+
+    def fuse(self, virtual_machine, address, fallback):
+        """ Superinstruction starting at address
+
+        Args:
+            virtual_machine (VirtualMachine): the virtual machine
+            address (int): address of the first instruction
+            fallback (function): plain closure of the first instruction
+
+        Returns:
+            (function, int) : the superinstruction and the address following
+                              its sequence, None if no pattern matches
+        """
+        sequence = self.sequence(virtual_machine, address)
+        for build in self.patterns:
+            fused = build(virtual_machine, sequence, fallback, (self.fires, address))
+            if fused is not None:
+                (label, step, end) = fused
+                self.sites[address] = label
+                return (step, end)
+        return None
+
+    def counts(self):
+        """ Fires per fused sequence
+
+        Returns:
+            Counter : count per label
+        """
+        result = Counter()
+        for (address, label) in self.sites.items():
+            result[label] += self.fires[address]
+        return result
+
+    def report(self, file=None):
+        """ Prints how often each fused sequence fired and at how many addresses
+        """
+        sites = Counter(self.sites.values())
+        for (label, count) in self.counts().most_common():
+            print(f"{count:>12}  {label:<16} at {sites[label]} addresses", file = file)
+
+
+def operands(virtual_machine, *arguments):
+    """ Sources of operands (see VirtualMachine.source), None if one is invalid
+    """
+    sources = [virtual_machine.source(argument) for argument in arguments]
+    return None if None in sources else sources
+
+@pattern('xor')
+def exclusive_or(virtual_machine, sequence, fallback, counter):
+    """ and t, x, y / not t, t / or x, x, y / and x, x, t: x = x xor y
+    (t keeps not (x and y))
+    """
+    if [name for (name, _, _) in sequence[:4]] != ['and', 'not', 'or', 'and']:
+        return None
+    ((_, (t, x, y), _), (_, second, _), (_, third, _), (_, fourth, end)) = sequence[:4]
+    if virtual_machine.register(t) is None or virtual_machine.register(x) is None or t in (x, y) or \
+            tuple(second) != (t, t) or tuple(third) != (x, x, y) or tuple(fourth) != (x, x, t):
+        return None
+    (words, (values, y)) = (virtual_machine.memory.memory, virtual_machine.source(y))
+    (fires, site) = counter
+    def step():
+        fires[site] += 1
+        (left, right) = (words[x], values[y])
+        words[t] = (left & right) ^ 32767
+        words[x] = left ^ right
+        return end
+    return ('xor', step, end)
+
+@pattern('test')
+def test_and_branch(virtual_machine, sequence, fallback, counter):
+    """ An operation followed by jt or jf on its result, such as the
+    decrement add x, x, 32767 / jt x, loop
+    """
+    if len(sequence) < 2 or sequence[0][0] not in TESTED or sequence[1][0] not in ('jt', 'jf'):
+        return None
+    ((name, (a, b, c), _), (branch, (condition, destination), end)) = sequence[:2]
+    sources = operands(virtual_machine, b, c, destination)
+    if virtual_machine.register(a) is None or condition != a or sources is None:
+        return None
+    (words, function) = (virtual_machine.memory.memory, TESTED[name])
+    ((lefts, b), (rights, c), (destinations, d)) = sources
+    (fires, site) = counter
+    if branch == 'jt':
+        def step():
+            fires[site] += 1
+            value = function(lefts[b], rights[c]) & 32767
+            words[a] = value
+            return destinations[d] if value else end
+    else:
+        def step():
+            fires[site] += 1
+            value = function(lefts[b], rights[c]) & 32767
+            words[a] = value
+            return end if value else destinations[d]
+    return (f"{name}/{branch}", step, end)
+
+@pattern('push')
+def push_run(virtual_machine, sequence, fallback, counter):
+    """ Registers pushed in a row (saving them at the start of a routine),
+    with the call following them if any
+    """
+    registers = []
+    for (name, args, _) in sequence:
+        if name != 'push' or virtual_machine.register(args[0]) is None:
+            break
+        registers.append(args[0])
+    if len(registers) < 2:
+        return None
+    end = sequence[len(registers) - 1][2]
+    (words, stack) = (virtual_machine.memory.memory, virtual_machine.stack.stack)
+    (fires, site) = counter
+    getter = itemgetter(*registers)
+    (name, args, following) = sequence[len(registers)] if len(sequence) > len(registers) else (None, None, end)
+    called = name == 'call' and operands(virtual_machine, args[0])
+    if not called:
+        def step():
+            fires[site] += 1
+            stack.extend(getter(words))
+            return end
+        return (f"push*{len(registers)}", step, end)
+    ((values, a),) = called
+    call_stack = virtual_machine.call_stack
+    def step():
+        fires[site] += 1
+        stack.extend(getter(words))
+        address = values[a]
+        call_stack.append(address)
+        stack.append(following)
+        return address
+    return (f"push*{len(registers)}/call", step, following)
+
+@pattern('pop')
+def pop_run(virtual_machine, sequence, fallback, counter):
+    """ Registers popped in a row (restoring them at the end of a routine),
+    with the ret following them if any
+    """
+    registers = []
+    for (name, args, _) in sequence:
+        if name != 'pop' or virtual_machine.register(args[0]) is None:
+            break
+        registers.append(args[0])
+    returns = len(sequence) > len(registers) and sequence[len(registers)][0] == 'ret'
+    if len(registers) < (1 if returns else 2):
+        return None
+    end = sequence[len(registers) - 1][2]
+    (words, stack, call_stack) = (virtual_machine.memory.memory, virtual_machine.stack.stack,
+                                  virtual_machine.call_stack)
+    (fires, site, count) = (*counter, len(registers))
+    if not returns:
+        def step():
+            if len(stack) < count:
+                return fallback()
+            fires[site] += 1
+            for register in registers:
+                words[register] = stack.pop()
+            return end
+        return (f"pop*{count}", step, end)
+    def step():
+        if len(stack) <= count or not call_stack:
+            return fallback()
+        fires[site] += 1
+        for register in registers:
+            words[register] = stack.pop()
+        call_stack.pop()
+        return stack.pop()
+    return (f"pop*{count}/ret", step, sequence[count][2])
+
+@pattern('call')
+def set_and_call(virtual_machine, sequence, fallback, counter):
+    """ set r, value / call address: passing an argument to a routine
+    """
+    if [name for (name, _, _) in sequence[:2]] != ['set', 'call']:
+        return None
+    ((_, (a, b), _), (_, (address,), following)) = sequence[:2]
+    sources = operands(virtual_machine, b, address)
+    if virtual_machine.register(a) is None or sources is None:
+        return None
+    (words, stack, call_stack) = (virtual_machine.memory.memory, virtual_machine.stack.stack,
+                                  virtual_machine.call_stack)
+    ((values, b), (addresses, c)) = sources
+    (fires, site) = counter
+    def step():
+        fires[site] += 1
+        words[a] = values[b]
+        address = addresses[c]
+        call_stack.append(address)
+        stack.append(following)
+        return address
+    return ('set/call', step, following)
+
@@ -0,0 +1,227 @@
+""" Module recording the instructions executed by the virtual machine"""
+import mmap
+import struct
+import argparse
+from array import array
+from constants import MAX_ADDRESS, HOOK
+
+TRACE_MAGIC = b'SYNT'
+TRACE_HEADER = struct.Struct('<4sHH')  # magic, words per record, reserved
+RECORD_FIELDS = ('cursor', 'opcode', 'a', 'b', 'c', 'target', 'value')
+RECORD_WORDS = len(RECORD_FIELDS)
+NO_TARGET = 0xFFFF
+# what an operation writes: 1 the register a, 2 the address held by a (wmem)
+WRITES = (0, 1, 0, 1, 1, 1, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 2, 0, 0, 0, 1, 0)
+
+
+class Tracer:
+    """ Execution trace filled by VirtualMachine.run_traced
+
+    A record is RECORD_WORDS 16 bits words: the cursor, the word at the cursor
+    and the three following ones (only the operands of the operation are
+    meaningful), the memory address or register written (NO_TARGET if none)
+    and the value written. The changes made by the hacks of a hooked address
+    are recorded before its instruction, one HOOK record per word changed.
+    Records are buffered in an array and appended to
+    the file every flush_every records; without a file only the last capacity
+    records are kept (ring buffer).
+    """
+    def __init__(self, filename=None, capacity=1 << 20, flush_every=1 << 16):
+        self.buffer = array('H')
+        self.limit = RECORD_WORDS * (flush_every if filename else 2 * capacity)
+        self.capacity = capacity
+        self.written = 0
+        self.file = None
+        if filename:
+            self.file = open(filename, 'wb')
+            self.file.write(TRACE_HEADER.pack(TRACE_MAGIC, RECORD_WORDS, 0))
+
+    @property
+    def count(self):
+        """ Number of records (instructions and hook changes) so far
+        """
+        return self.written + len(self.buffer) // RECORD_WORDS
+
+    def flush(self):
+        """ Appends the buffered records to the file, or drops the oldest
+        records beyond the capacity of the ring buffer
+        """
+        if self.file is None:
+            dropped = max(0, len(self.buffer) // RECORD_WORDS - self.capacity)
+            del self.buffer[:dropped * RECORD_WORDS]
+        else:
+            dropped = len(self.buffer) // RECORD_WORDS
+            self.buffer.tofile(self.file)
+            del self.buffer[:]
+        self.written += dropped
+
+    def close(self):
+        """ Flushes and closes the file
+        """
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def reader(self):
+        """ Reader over the records kept in memory (ring buffer mode)
+
+        Returns:
+            TraceReader : reader whose first record is instruction number self.written
+        """
+        self.flush()
+        return TraceReader(TRACE_HEADER.pack(TRACE_MAGIC, RECORD_WORDS, 0) + self.buffer.tobytes(),
+                           self.written)
+
+
+class TraceReader:
+    """ Random access to the records of a trace, files are mapped rather than read
+
+    Args:
+        source (string or bytes): path of the trace file or its content
+        first (int, optional): instruction number of the first record
+    """
+    def __init__(self, source, first=0):
+        if isinstance(source, str):
+            with open(source, 'rb') as file:
+                source = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) \
+                    if file.seek(0, 2) > TRACE_HEADER.size else b''
+        (magic, words, _) = TRACE_HEADER.unpack_from(source) if len(source) >= TRACE_HEADER.size \
+            else (TRACE_MAGIC, RECORD_WORDS, 0)
+        if magic != TRACE_MAGIC or words != RECORD_WORDS:
+            raise ValueError("Not an execution trace")
+        body = memoryview(source)[TRACE_HEADER.size:]
+        self.words = body[:len(body) - len(body) % (2 * RECORD_WORDS)].cast('H')
+        self.first = first
+
+    def __len__(self):
+        return len(self.words) // RECORD_WORDS
+
+    def __getitem__(self, count):
+        """ Record of the given instruction number (see RECORD_FIELDS)
+
+        Returns:
+            tuple : the record
+        """
+        index = (count - self.first) * RECORD_WORDS
+        if not 0 <= index < len(self.words):
+            raise IndexError(f"Instruction {count} is not in the trace")
+        return tuple(self.words[index:index + RECORD_WORDS])
+
+    def column(self, field):
+        """ One field of every record
+
+        Args:
+            field (string): name of the field, see RECORD_FIELDS
+
+        Returns:
+            list : the values in execution order
+        """
+        return self.words[RECORD_FIELDS.index(field)::RECORD_WORDS].tolist()
+
+    def span(self, start=None, stop=None):
+        """ Words of the records of instructions start to stop (excluded),
+        clipped to the trace
+
+        Returns:
+            (int, memoryview) : instruction number of the first record and the words
+        """
+        start = self.first if start is None else max(start, self.first)
+        stop = self.first + len(self) if stop is None else max(start, min(stop, self.first + len(self)))
+        return (start, self.words[(start - self.first) * RECORD_WORDS:(stop - self.first) * RECORD_WORDS])
+
+    def records(self, start=None, stop=None):
+        """ Iterates over the records of instructions start to stop (excluded)
+
+        Yields:
+            (int, tuple) : instruction number and record
+        """
+        (start, words) = self.span(start, stop)
+        yield from enumerate(zip(*(iter(words.tolist()),) * RECORD_WORDS), start)
+
+    def find(self, address, start=None, limit=None):
+        """ Instruction numbers at which the cursor was at address
+
+        Args:
+            address (int): address of the instruction
+            start (int, optional): first instruction number to look at
+            limit (int, optional): maximal number of results
+
+        Returns:
+            list : the instruction numbers in execution order
+        """
+        begin = 0 if start is None else max(0, start - self.first)
+        cursors = self.words[begin * RECORD_WORDS::RECORD_WORDS].tolist()
+        found, index = [], -1
+        while limit is None or len(found) < limit:
+            try:
+                index = cursors.index(address, index + 1)
+            except ValueError:
+                break
+            found.append(self.first + begin + index)
+        return found
+
+    def writes(self, address, start=None, stop=None):
+        """ Instruction numbers and values of the writes to a memory address or register
+
+        Returns:
+            list : (instruction number, value) in execution order
+        """
+        return [(count, record[6]) for (count, record) in self.records(start, stop) if record[5] == address]
+
+    def replay(self, memory, stop=None, start=None):
+        """ Applies the writes of the records start to stop to memory, giving
+        the memory and registers right before instruction stop when memory
+        held the state before instruction start
+
+        Args:
+            memory (array): MAX_ADDRESS + 8 words, updated in place
+
+        Returns:
+            array : memory
+        """
+        (_, words) = self.span(start, stop)
+        for (target, value) in zip(words[5::RECORD_WORDS].tolist(), words[6::RECORD_WORDS].tolist()):
+            if target != NO_TARGET:
+                memory[target] = value
+        return memory
+
+    def lines(self, instructions, start=None, stop=None):
+        """ Text of the records of instructions start to stop
+
+        Args:
+            instructions (dict): operations of the virtual machine by code
+
+        Yields:
+            string : instruction number, cursor, operation, operands and write
+        """
+        def operand(word):
+            return "r" + "abcdefgh"[word - MAX_ADDRESS] if MAX_ADDRESS <= word < MAX_ADDRESS + 8 else str(word)
+        for (count, (cursor, opcode, *operands, target, value)) in self.records(start, stop):
+            (name, arity) = ('hook', 0) if opcode == HOOK else instructions.get(opcode, ('????', 0))
+            line = f"{count:>10} [{cursor:<5}] {name} " + ", ".join(operand(word) for word in operands[:arity])
+            if target != NO_TARGET:
+                line = f"{line:<50}; {operand(target)} = {value}"
+            yield line
+
+
+if __name__ == '__main__':
+    from virtual_machine import VirtualMachine
+    parser = argparse.ArgumentParser(description="Prints the records of an execution trace")
+    parser.add_argument('trace', help="trace file written with virtual_machine.py --trace")
+    parser.add_argument('--start', type=int, default=None, help="first instruction number")
+    parser.add_argument('--count', type=int, default=50, help="number of instructions to print")
+    parser.add_argument('--address', type=int, default=None,
+                        help="start at the first visit of this address (after --start)")
+    arguments = parser.parse_args()
+    reader = TraceReader(arguments.trace)
+    start = arguments.start
+    if arguments.address is not None:
+        visits = reader.find(arguments.address, start, limit=1)
+        if not visits:
+            parser.exit(1, f"{arguments.address} is never executed\n")
+        start = visits[0]
+    start = reader.first if start is None else start
+    instructions = VirtualMachine(None).instructions
+    for text in reader.lines(instructions, start, start + arguments.count):
+        print(text)
@@ -1,10 +1,32 @@
 """Module implementing the virtual machine"""
+import os
+import re
 import sys
-import itertools
+import mmap
+import zlib
+import struct
+import hashlib
+import importlib
+import argparse
 from array import array
 from collections import defaultdict
+from contextlib import contextmanager
 from dumper import Dumper
-MAX_ADDRESS = 32768
+from profiler import Profiler
+from tracer import Tracer, NO_TARGET, WRITES
+from history import ENTRY_WORDS
+from constants import MAX_ADDRESS, REGISTER_NAMES, HOOK
+from natives import NATIVES, Native
+from superinstructions import Superinstructions
+MAX_BLOCK_LENGTH = 64
+FUNCTION_NAME = re.compile(r"([\w.]+):(\w+)")
+PAGE_SIZE = 256
+SNAPSHOT_MAGIC = b'SYN2'
+SNAPSHOT_HEADER = struct.Struct('<4sHIIII') # magic, cursor, input position, stack, call stack
+                                            # and pending input sizes
+BOOT_MAGIC = b'SYNB'
+BOOT_HEADER = struct.Struct('<4sHIII')      # magic, cursor, stack and call stack sizes, output length
+BOOT_CACHE = "Dumps/boot"
 
 
 class RuntimeException(Exception):
@@ -12,26 +34,59 @@ class RuntimeException(Exception):
     """
     pass
 
+class WaitingForInput(Exception):
+    """ Raised by players that have no input yet, the virtual machine stops
+    on the in instruction and reads again when run is called next time
+    """
+    pass
+
+@contextmanager
+def mapped_file(filename):
+    """ Maps a file read-only, views of the mapping must be released before leaving
+
+    Args:
+        filename (string): path of the file
+
+    Yields:
+        mmap : the mapping (empty bytes for an empty file)
+    """
+    with open(filename, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            yield b''
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield data
+
 class VirtualMachineMemory:
     """ Virtual machine memory (Both registers and normal memory)
+
+    Memory and registers share one flat buffer: register n lives right after
+    the memory at MAX_ADDRESS + n, so an operand is directly its own index.
+    visited marks every address execution was decoded at, unlike the caches
+    it survives flushes (the disassembler uses it for indirect jump targets).
     """
     def __init__(self):
-        self.registers = array('H', [0, 0, 0, 0, 0, 0, 0, 0])
-        self.memory = array('H', itertools.repeat(0, 0x10000))
+        self.memory = array('H', bytes(2 * (MAX_ADDRESS + 8)))
+        self.decoded = [None] * (MAX_ADDRESS + 8)
+        self.covered = bytearray(MAX_ADDRESS + 8)
+        self.visited = bytearray(MAX_ADDRESS + 8)
+        self.dirty = bytearray(MAX_ADDRESS // PAGE_SIZE + 1)
+        self.version = 0
+
+    @property
+    def registers(self):
+        """ Writable view of the eight registers
+        """
+        return memoryview(self.memory)[MAX_ADDRESS:]
 
     def __getitem__(self, address):
-        if 0 <= address < MAX_ADDRESS:
+        if 0 <= address < MAX_ADDRESS + 8:
             return self.memory[address]
-        elif MAX_ADDRESS <= address < MAX_ADDRESS + 8:
-            return self.registers[address - MAX_ADDRESS]
-        else:
-            raise RuntimeException(f"Address {address} is invalid")
+        raise RuntimeException(f"Address {address} is invalid")
 
     def __setitem__(self, address, value):
-        if 0 <= address < MAX_ADDRESS:
-            self.memory[address] = value % MAX_ADDRESS
-        elif MAX_ADDRESS <= address < MAX_ADDRESS + 8:
-            self.registers[address - MAX_ADDRESS] = value % MAX_ADDRESS
+        if 0 <= address < MAX_ADDRESS + 8:
+            self.store(address, value)
         else:
             raise RuntimeException(f"Address {address} is neither memory nor register")
 
@@ -47,12 +102,34 @@ class VirtualMachineMemory:
         Returns:
             int : the value at given register or address.
         """
-        if 0 <= address < MAX_ADDRESS:
+        if address < MAX_ADDRESS:
             return address
-        elif MAX_ADDRESS <= address < MAX_ADDRESS + 8:
-            return self.registers[address - MAX_ADDRESS]
-        else:
-            raise RuntimeException(f"Value {address} is invalid as a number or a register")
+        try:
+            return self.memory[address]
+        except IndexError as index_error:
+            raise RuntimeException(f"Value {address} is invalid as a number or a register") \
+                from index_error
+
+    def values(self, *operands):
+        """ Values of already validated operands (see next_instruction)
+
+        Returns:
+            list : the value of each operand
+        """
+        memory = self.memory
+        return [operand if operand < MAX_ADDRESS else memory[operand] for operand in operands]
+
+    def store(self, address, value):
+        """ Writes to an already validated memory address or register
+
+        Args:
+            address (int): address satisfying 0 <= start < 2**15 + 8
+            value (int): value to write, reduced modulo 2^15
+        """
+        self.memory[address] = value % MAX_ADDRESS
+        self.dirty[address // PAGE_SIZE] = 1
+        if self.covered[address]:
+            self.invalidate(address)
 
     def code_of(self, address):
         """ Name of the register for code dumping
@@ -66,11 +143,10 @@ class VirtualMachineMemory:
         Returns:
             string : value of the address (int or r*)
         """
-        codes = ['ra', 'rb', 'rc', 'rd', 're', 'rf', 'rg', 'rh']
         if 0 <= address < MAX_ADDRESS :
             return str(address)
         if MAX_ADDRESS <= address < MAX_ADDRESS + 8:
-            return codes[address - MAX_ADDRESS].lower()
+            return REGISTER_NAMES[address - MAX_ADDRESS]
         raise RuntimeException(f"Value {address} is invalid as a number or a register")
 
     def read(self, start, length):
@@ -85,6 +161,67 @@ class VirtualMachineMemory:
         """
         return self.memory[start:start + length]
 
+    def invalidate(self, address):
+        """ Drops the decoded instructions overlapping the given address
+
+        Words covered by a compiled block (marked 2 in covered) flush the
+        whole cache since blocks can start anywhere before them.
+
+        Args:
+            address (int): memory address that has just been written
+        """
+        if self.covered[address] > 1:
+            self.flush()
+            return
+        for start in range(max(0, address - 3), address + 1):
+            self.decoded[start] = None
+
+    def freeze(self, origin):
+        """ Memory as immutable pages, sharing the pages not written since origin
+
+        Args:
+            origin (tuple): pages the memory was thawed from, None to copy everything
+
+        Returns:
+            tuple : one bytes object per page of PAGE_SIZE words
+        """
+        pages = tuple(
+            self.memory[start:start + PAGE_SIZE].tobytes()
+            if origin is None or self.dirty[page] else origin[page]
+            for (page, start) in enumerate(range(0, MAX_ADDRESS, PAGE_SIZE)))
+        self.dirty[:] = bytes(len(self.dirty))
+        return pages
+
+    def thaw(self, pages, origin):
+        """ Loads pages into memory, copying only those that differ from origin
+
+        Decoded instructions are only dropped where a decoded word changes.
+
+        Args:
+            pages (tuple): pages returned by freeze
+            origin (tuple): pages the memory currently holds (up to dirty ones), or None
+        """
+        changed = []
+        for (page, start) in enumerate(range(0, MAX_ADDRESS, PAGE_SIZE)):
+            if origin is None or self.dirty[page] or pages[page] is not origin[page]:
+                current, words = self.memory[start:start + PAGE_SIZE], array('H', pages[page])
+                if current == words:
+                    continue
+                self.memory[start:start + PAGE_SIZE] = words
+                if any(self.covered[start:start + PAGE_SIZE]):
+                    changed += [start + offset for offset in range(PAGE_SIZE)
+                                if self.covered[start + offset] and current[offset] != words[offset]]
+        self.dirty[:] = bytes(len(self.dirty))
+        for address in changed:
+            self.invalidate(address)
+
+    def flush(self):
+        """ Drops every decoded instruction and compiled block
+        """
+        self.decoded[:] = [None] * len(self.decoded)
+        self.covered[:] = bytes(len(self.covered))
+        self.version += 1
+
 
 class VirtualMachineStack:
     """ Simple stack class
@@ -112,9 +249,22 @@ class VirtualMachineStack:
 class VirtualMachine:
     """ VirtualMachine
     """
-    def __init__(self, player):
+    def __init__(self, player, fast=True, jit=True, fuse=False):
         self.player = player
+        self.fast = fast
+        self.jit = jit
+        self.superinstructions = Superinstructions() if fuse else None
+        self.blocks = {}
+        self.output = []
+        self.pending = []
+        self.profiler = None
+        self.tracer = None
+        self.history = None
+        self.origin = None
         self.hacks = defaultdict(list)
+        self.natives = {}
+        self.names = {}
+        self.hooked = bytearray(MAX_ADDRESS + 8)
         self.memory = VirtualMachineMemory()
         self.stack = VirtualMachineStack()
         self.call_stack = []
@@ -145,38 +295,750 @@ class VirtualMachine:
         }
         self.dumper = Dumper(self.memory, self.instructions)
     def load(self, filename):
-        """ loads the given filename as a program into memory
+        """ loads the given filename as a program into memory, the file is
+        mapped and copied straight into the memory
         Args:
             filename (string): path to the program
         Returns:
             int : the size of the program
         """
-        program = array('H')
+        with mapped_file(filename) as data, memoryview(data) as view:
+            size = min(len(view) // 2, MAX_ADDRESS)
+            with view[:2 * size].cast('H') as program:
+                memoryview(self.memory.memory)[:size] = program
+        self.memory.flush()
+        self.origin = None
+        return size
+
+    def boot(self, filename, cache=BOOT_CACHE):
+        """ Loads a program and runs it up to its first input or hooked
+        address, mapping a boot image of that state when one was saved for
+        the same program and hooked addresses (it is saved otherwise)
+
+        Hacks only change the state once they run and the boot stops before
+        the first one, so an image depends on where the hacks are and not on
+        their code: any other program or hooked address maps to another image.
+        The output of the boot is written to the player.
+
+        Args:
+            filename (string): path to the program
+            cache (string, optional): directory of the boot images, None to
+                                      always boot from the program
+
+        Returns:
+            bool : True if the state was mapped from a boot image
+        """
+        path = None if cache is None else os.path.join(cache, self.boot_key(filename) + ".img")
+        if path is not None:
+            try:
+                self.player.write(self.load_boot_image(path))
+                return True
+            except (OSError, ValueError):
+                pass
+        self.load(filename)
+        def stop(_):
+            raise WaitingForInput()
+        (player, hacks) = (self.player, self.hacks)
+        self.player = ScriptedPlayer([])
+        self.hacks = defaultdict(list, {cursor: [stop] for (cursor, hooked) in enumerate(self.hooked) if hooked})
+        try:
+            self.run()
+        finally:
+            (text, self.player, self.hacks) = (self.player.text(), player, hacks)
+        if path is not None:
+            self.save_boot_image(path, text)
+        self.player.write(text)
+        return False
+
+    def boot_key(self, filename):
+        """ Name of the boot image of a program with the current hooked addresses
+
+        Returns:
+            string : hexadecimal digest of the image format, the program and the addresses
+        """
+        digest = hashlib.sha256(BOOT_MAGIC)
+        with mapped_file(filename) as data:
+            digest.update(data)
+        digest.update(array('H', (cursor for (cursor, hooked) in enumerate(self.hooked) if hooked)).tobytes())
+        return digest.hexdigest()[:32]
+
+    def save_boot_image(self, path, text):
+        """ Writes the state as a boot image: the header, the memory and
+        registers, the stacks, the visited addresses and the output, none of
+        them compressed so that the image can be mapped
+
+        The image is written next to path then renamed so that a reader never
+        sees half of it, failing to write it only costs the next boot.
+
+        Args:
+            path (string): path of the image
+            text (string): output written by the program while booting
+        """
+        output = text.encode()
+        header = BOOT_HEADER.pack(BOOT_MAGIC, self.cursor, len(self.stack.stack), len(self.call_stack), len(output))
+        temporary = f"{path}.{os.getpid()}"
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(temporary, 'wb') as file:
+                file.write(header)
+                for words in (self.memory.memory, self.stack.stack, array('H', self.call_stack)):
+                    words.tofile(file)
+                file.write(self.memory.visited + output)
+            os.replace(temporary, path)
+        except OSError:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+    def load_boot_image(self, path):
+        """ Maps a boot image written by save_boot_image into the virtual machine
+
+        Args:
+            path (string): path of the image
+
+        Raises:
+            OSError: if the image cannot be read
+            ValueError: if the file is not a complete boot image
+
+        Returns:
+            string : output written by the program while booting
+        """
+        with mapped_file(path) as data, memoryview(data) as view:
+            if len(view) < BOOT_HEADER.size or view[:len(BOOT_MAGIC)] != BOOT_MAGIC:
+                raise ValueError("Not a boot image")
+            (_, cursor, stack, calls, length) = BOOT_HEADER.unpack_from(view)
+            words = MAX_ADDRESS + 8 + stack + calls
+            start = BOOT_HEADER.size + 2 * words
+            if len(view) != start + MAX_ADDRESS + 8 + length:
+                raise ValueError("Truncated boot image")
+            with view[BOOT_HEADER.size:start].cast('H') as body:
+                memoryview(self.memory.memory)[:] = body[:MAX_ADDRESS + 8]
+                self.stack.stack[:] = array('H', body[MAX_ADDRESS + 8:MAX_ADDRESS + 8 + stack])
+                self.call_stack[:] = body[MAX_ADDRESS + 8 + stack:].tolist()
+            self.memory.visited[:] = view[start:start + MAX_ADDRESS + 8]
+            text = bytes(view[start + MAX_ADDRESS + 8:]).decode()
+        self.memory.flush()
+        self.origin = None
+        self.pending.clear()
+        self.cursor = cursor
+        return text
+
+    def snapshot(self):
+        """ Serializes the whole state (memory, registers, stacks, cursor and
+        the position of the player in its input) into a compact binary string
+
+        Returns:
+            bytes : the snapshot
+        """
+        call_stack, pending = array('H', self.call_stack), array('H', self.pending)
+        header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, self.cursor, self.player.tell(),
+                                      len(self.stack.stack), len(call_stack), len(pending))
+        body = self.memory.memory.tobytes() + self.stack.stack.tobytes() + \
+            call_stack.tobytes() + pending.tobytes()
+        return header + zlib.compress(body, 1)
+
+    def restore(self, snapshot):
+        """ Restores a state serialized by snapshot
+
+        The buffers are updated in place since the decoded instructions keep
+        references to them.
+
+        Args:
+            snapshot (bytes): the snapshot
+
+        Raises:
+            RuntimeException: if the data is not a snapshot
+        """
+        if snapshot[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise RuntimeException("Not a virtual machine snapshot")
+        (_, cursor, position, *sizes) = SNAPSHOT_HEADER.unpack_from(snapshot)
+        words = array('H')
+        words.frombytes(zlib.decompress(snapshot[SNAPSHOT_HEADER.size:]))
+        start = len(self.memory.memory)
+        self.memory.memory[:] = words[:start]
+        for (target, size) in zip((self.stack.stack, self.call_stack, self.pending), sizes):
+            target[:] = words[start:start + size]
+            start += size
+        self.memory.flush()
+        self.origin = None
+        self.cursor = cursor
+        self.player.seek(position)
+
+    def fork(self):
+        """ Freezes the current state into a fork sharing the memory pages that
+        were not written since the fork the machine was last resumed from
+
+        Returns:
+            VirtualMachineFork : the frozen state
+        """
+        pages = self.memory.freeze(None if self.origin is None else self.origin.pages)
+        self.origin = VirtualMachineFork(pages, self.memory.memory[MAX_ADDRESS:].tobytes(),
+                                         self.stack.stack.tobytes(), tuple(self.call_stack),
+                                         self.cursor, tuple(self.pending))
+        return self.origin
+
+    def resume(self, fork):
+        """ Loads a fork into the virtual machine, copying only the pages that differ
+
+        Args:
+            fork (VirtualMachineFork): state returned by fork
+        """
+        self.memory.thaw(fork.pages, None if self.origin is None else self.origin.pages)
+        self.memory.memory[MAX_ADDRESS:] = array('H', fork.registers)
+        self.stack.stack[:] = array('H', fork.stack)
+        self.call_stack[:] = fork.call_stack
+        self.pending[:] = fork.pending
+        self.cursor = fork.cursor
+        self.origin = fork
+
+    def branch(self, fork, commands):
+        """ Plays commands from a fork and forks the resulting state
+
+        Args:
+            fork (VirtualMachineFork): state to start from
+            commands (list): commands to type, one per line
+
+        Returns:
+            (VirtualMachineFork, string, bool) : resulting state, output and
+                whether the game is still waiting for input (False if it halted)
+        """
+        self.resume(fork)
+        self.player = ScriptedPlayer(commands)
+        waiting = self.run()
+        return (self.fork(), self.player.text(), waiting)
+
+    def save_snapshot(self, filename):
+        """ Writes a snapshot of the current state to a file
+
+        Args:
+            filename (string): path of the snapshot
+        """
+        with open(filename, 'wb') as file:
+            file.write(self.snapshot())
+
+    def load_snapshot(self, filename):
+        """ Restores the state saved in a snapshot file
+
+        Args:
+            filename (string): path of the snapshot
+        """
         with open(filename, 'rb') as file:
-            program.frombytes(file.read())
-        self.memory.memory[0:len(program)] = program
+            self.restore(file.read())
 
     def run(self):
-        """ Runs the virtual machine
+        """ Runs the virtual machine until it halts or the player runs out of input
+
+        Returns:
+            bool : True if the virtual machine is waiting for input, False if it halted
         """
-        while self.next():
-            continue
+        try:
+            if self.profiler is not None:
+                self.run_profiled()
+            elif self.tracer is not None:
+                self.run_traced()
+            elif self.history is not None:
+                self.run_recorded()
+            elif self.fast:
+                self.run_fast()
+            else:
+                while self.next():
+                    continue
+        except WaitingForInput:
+            return True
+        finally:
+            self.flush_output()
+        return False
+
+    def run_for(self, quantum):
+        """ Runs at most quantum steps: decoded instructions or compiled blocks
+        (of up to MAX_BLOCK_LENGTH instructions), single instructions with the
+        interpreter
+
+        Args:
+            quantum (int): number of steps
+
+        Returns:
+            string : "halted", "input" when waiting for input or "quantum" when
+                     the quantum ran out
+        """
+        halted = False
+        try:
+            if self.fast:
+                (decoded, fetch, cursor) = (self.memory.decoded, self.fetch, self.cursor)
+                try:
+                    while cursor >= 0 and quantum > 0:
+                        cursor = (decoded[cursor] or fetch(cursor))()
+                        quantum -= 1
+                finally:
+                    if cursor >= 0:
+                        self.cursor = cursor
+                halted = cursor < 0
+            else:
+                while quantum > 0 and not halted:
+                    halted = not self.next()
+                    quantum -= 1
+        except WaitingForInput:
+            return "input"
+        finally:
+            self.flush_output()
+        return "halted" if halted else "quantum"
+
+    def read_input(self):
+        """ Next character typed by the player, asking the player for a whole
+        line when the previous one has been consumed
+
+        Raises:
+            WaitingForInput: if the player has no more input
+
+        Returns:
+            int : the character code
+        """
+        if not self.pending:
+            self.flush_output()
+            line = self.player.read_line()
+            if not line:
+                raise WaitingForInput()
+            self.pending.extend(ord(char) % MAX_ADDRESS for char in reversed(line))
+        return self.pending.pop()
+
+    def escape(self, command):
+        """ Runs a "!" command typed by the player: "save <filename>" saves a
+        snapshot, "<address>:<code>" adds a hack
+
+        Args:
+            command (string): the line without the leading "!"
+
+        Raises:
+            SyntaxError: if the hack does not compile
+            ValueError: if the command is not understood
+        """
+        command = command.strip()
+        if command.startswith("save "):
+            self.save_snapshot(command[len("save "):].strip())
+            return
+        [cursor, code] = command.split(":",1)
+        self.hack(int(cursor), code)
+
+    def flush_output(self):
+        """ Sends the characters written by out since the last flush to the player
+        """
+        if self.output:
+            self.player.write("".join(self.output))
+            self.output.clear()
+
+    def run_fast(self):
+        """ Runs the virtual machine using the pre-decoded instruction cache
+        """
+        decoded = self.memory.decoded
+        fetch = self.fetch
+        cursor = self.cursor
+        try:
+            while cursor >= 0:
+                cursor = (decoded[cursor] or fetch(cursor))()
+        finally:
+            if cursor >= 0:
+                self.cursor = cursor
+
+    def run_profiled(self):
+        """ Runs the virtual machine one decoded instruction at a time (no JIT),
+        recording execution counts and calls into self.profiler
+        """
+        profiler, call_stack, decoded = self.profiler, self.call_stack, self.memory.decoded
+        counts = profiler.counts
+        (jit, self.jit) = (self.jit, False)
+        (superinstructions, self.superinstructions) = (self.superinstructions, None)
+        self.memory.flush()
+        (executed, cursor) = (profiler.executed, self.cursor)
+        try:
+            while cursor >= 0:
+                (address, depth) = (cursor, len(call_stack))
+                cursor = (decoded[cursor] or self.fetch(cursor))()
+                counts[address] += 1
+                executed += 1
+                if len(call_stack) > depth:
+                    profiler.enter(call_stack[-2] if depth else 0, call_stack[-1], executed)
+                elif len(call_stack) < depth:
+                    profiler.leave(executed)
+        finally:
+            if cursor >= 0:
+                self.cursor = cursor
+            profiler.executed = executed
+            self.jit = jit
+            self.superinstructions = superinstructions
+            self.memory.flush()
+
+    def run_traced(self):
+        """ Runs the virtual machine one decoded instruction at a time (no JIT),
+        appending a record per instruction to self.tracer
+
+        The decoded closures are replaced by closures also appending their
+        record (see trace_step), so only the written word is read at run time.
+        The hacks of a hooked address are applied here: a HOOK record is
+        appended for each word of memory or register they change (a single one
+        without target if they change none), then the instruction is recorded
+        unless they moved the cursor.
+        """
+        tracer, decoded, words = self.tracer, self.memory.decoded, self.memory.memory
+        (buffer, limit, hooked) = (tracer.buffer, tracer.limit, self.hooked)
+        (jit, self.jit) = (self.jit, False)
+        (superinstructions, self.superinstructions) = (self.superinstructions, None)
+        self.memory.flush()
+        cursor = self.cursor
+        try:
+            while cursor >= 0:
+                step = decoded[cursor]
+                if step is not None:
+                    cursor = step()
+                    if len(buffer) >= limit:
+                        tracer.flush()
+                    continue
+                address = cursor
+                if hooked[address]:
+                    (self.cursor, before) = (address, words[:])
+                    self.apply_hacks()
+                    changes = [(target, words[target]) for start in range(0, len(words), PAGE_SIZE)
+                               if words[start:start + PAGE_SIZE] != before[start:start + PAGE_SIZE]
+                               for target in range(start, min(start + PAGE_SIZE, len(words)))
+                               if words[target] != before[target]] or [(NO_TARGET, 0)]
+                    for (target, value) in changes:
+                        buffer.extend((address, HOOK, 0, 0, 0, target, value))
+                    if self.cursor != address:
+                        cursor = self.cursor
+                        continue
+                    step = self.trace_step(address, buffer)
+                    decoded[address] = None
+                    cursor = step()
+                else:
+                    cursor = self.trace_step(address, buffer)()
+                if len(buffer) >= limit:
+                    tracer.flush()
+        finally:
+            if cursor >= 0:
+                self.cursor = cursor
+            tracer.flush()
+            self.jit = jit
+            self.superinstructions = superinstructions
+            self.memory.flush()
+
+    def trace_step(self, address, buffer):
+        """ Decodes the instruction at address into a closure running it and
+        appending its trace record to buffer, the record is packed once here
+        and only its written word is filled when it runs
+
+        Args:
+            address (int): address of the instruction
+            buffer (array): records of the tracer
+
+        Returns:
+            function : the closure, also cached like the one of decode
+        """
+        (step, words) = (self.decode(address), self.memory.memory)
+        (opcode, a, b, c) = words[address:address + 4]
+        (kind, extend) = (WRITES[opcode], buffer.extend)
+        record = array('H', (address, opcode, a, b, c, a if kind else NO_TARGET, 0))
+        if kind == 1 or kind == 2 and a < MAX_ADDRESS:
+            def traced():
+                cursor = step()
+                record[6] = words[a]
+                extend(record)
+                return cursor
+        elif kind == 2:
+            def traced():
+                cursor = step()
+                record[5] = target = words[a]
+                record[6] = words[target]
+                extend(record)
+                return cursor
+        else:
+            def traced():
+                cursor = step()
+                extend(record)
+                return cursor
+        self.memory.decoded[address] = traced
+        return traced
+
+    def run_recorded(self):
+        """ Runs the virtual machine one decoded instruction at a time (no JIT),
+        logging into self.history (a history.ExecutionHistory set by the
+        caller) what is needed to undo each instruction
+        """
+        history, decoded, words = self.history, self.memory.decoded, self.memory.memory
+        (stack, call_stack, hooked) = (self.stack.stack, self.call_stack, self.hooked)
+        (jit, self.jit) = (self.jit, False)
+        (superinstructions, self.superinstructions) = (self.superinstructions, None)
+        self.memory.flush()
+        cursor = self.cursor
+        segment = history.segments[-1] if history.segments else None
+        log = segment and segment.log
+        try:
+            while cursor >= 0:
+                address = cursor
+                if history.due():
+                    self.cursor = address
+                    segment = history.checkpoint(self.fork())
+                    log = segment.log
+                if hooked[address]:
+                    self.cursor = address
+                    segment.forks.append(self.fork())
+                    cursor = (decoded[cursor] or self.fetch(cursor))()
+                    log.extend((address, HOOK, NO_TARGET, len(segment.forks) - 1, 0, 0))
+                    continue
+                (opcode, a) = words[address:address + 2]
+                kind = WRITES[opcode] if opcode < len(WRITES) else 0
+                target = NO_TARGET if not kind else a if kind == 1 or a < MAX_ADDRESS else words[a]
+                entry = (address, opcode, target, words[target] if kind else 0,
+                         stack[-1] if stack else 0, call_stack[-1] if call_stack else 0)
+                cursor = (decoded[cursor] or self.fetch(cursor))()
+                log.extend(entry)
+                if opcode == 20:
+                    log[-2] = words[target]
+        finally:
+            if cursor >= 0:
+                self.cursor = cursor
+            self.jit = jit
+            self.superinstructions = superinstructions
+            self.memory.flush()
+
+    def step_back(self, count=1):
+        """ Undoes the last instructions recorded in self.history, whole
+        segments are skipped by resuming their fork (the output is not undone)
+
+        The characters read since are pushed back to the pending input, so
+        running again reads the same input without the player.
+
+        Args:
+            count (int, optional): number of instructions to undo
+
+        Returns:
+            int : number of instructions undone, less than count when the
+                  history is exhausted
+        """
+        history, words = self.history, self.memory.memory
+        (stack, call_stack) = (self.stack.stack, self.call_stack)
+        target = max(history.start, history.count - count)
+        undone = history.count - target
+        while history.count > target:
+            segment = history.segments[-1]
+            if segment.start >= target:
+                entries = segment.log.tolist()
+                read = [entries[index + 4] for index in range(len(entries) - ENTRY_WORDS, -1, -ENTRY_WORDS)
+                        if entries[index + 1] == 20]
+                pending = self.pending + read
+                self.resume(segment.fork)
+                self.pending[:] = pending
+                if segment.start > target:
+                    history.segments.pop()
+                    continue
+                del segment.log[:]
+                segment.forks.clear()
+                break
+            for _ in range(history.count - target):
+                (cursor, opcode, address, old, top, call_top) = segment.log[-ENTRY_WORDS:]
+                del segment.log[-ENTRY_WORDS:]
+                self.cursor = cursor
+                if opcode == HOOK:
+                    pending = list(self.pending)
+                    self.resume(segment.forks.pop())
+                    self.pending[:] = pending
+                    continue
+                if opcode == 20:
+                    self.pending.append(top)
+                if address != NO_TARGET:
+                    self.memory.store(address, old)
+                if opcode in (2, 17):
+                    stack.pop()
+                elif opcode in (3, 18):
+                    stack.append(top)
+                if opcode == 17:
+                    call_stack.pop()
+                elif opcode == 18:
+                    call_stack.append(call_top)
+        return undone
+
+    def run_back_to(self, address):
+        """ Goes back to the last time the instruction at address was about to run
+
+        Args:
+            address (int): address of the instruction
+
+        Returns:
+            bool : False if it is not in the history (nothing is undone)
+        """
+        visit = self.history.last_visit(address)
+        if visit is None:
+            return False
+        self.step_back(self.history.count - visit)
+        return True
+
+    def fetch(self, cursor):
+        """ Slow path of run_fast: applies hacks and decodes the instruction
+
+        Instructions at hacked addresses are never cached so that the hacks
+        are evaluated on every visit.
+
+        Args:
+            cursor (int): address of the instruction
+
+        Returns:
+            function : closure executing the instruction (or a whole block)
+        """
+        hacked = self.hooked[cursor]
+        if hacked:
+            self.cursor = cursor
+            self.apply_hacks()
+            if self.cursor != cursor:
+                return lambda: self.cursor
+        step = self.compile_block(cursor) if self.jit else None
+        if step is None:
+            step = self.decode(cursor)
+        if hacked:
+            self.memory.decoded[cursor] = None
+        return step
 
     def hack(self, cursor, code) :
         """ Dangerous ! evaluates the given code when we visit the given cursor address
 
+        String code is compiled once here and evaluated with the virtual
+        machine bound to self (and the names of load_hacks), callables are
+        called with the virtual machine.
+
         Args:
             cursor (int): address to run code at
-            code (string): code to run
+            code (string or callable): code to run
+
+        Raises:
+            SyntaxError: if the code is a string that does not compile
         """
+        if isinstance(code, str):
+            compiled = compile(code.strip(), f"<hack {cursor}>", 'eval')
+            code = lambda virtual_machine: eval(compiled, globals(), {**virtual_machine.names, 'self': virtual_machine})
         self.hacks[cursor].append(code)
+        self.hooked[cursor] = 1
+        if self.memory.covered[cursor] > 1:
+            self.memory.flush()
+        self.memory.decoded[cursor] = None
+
+    def load_hacks(self, filename, exclude=None):
+        """ Registers the hacks of a file: a line "<address> : <code>" hooks
+        code at address, a line "native : <address>" binds the native routine
+        at address (see bind) and a line "<name> : <expression>" evaluates the
+        expression now, before the program runs, so that hooks can use its
+        value as name. The expression may be "<module>:<function>", the
+        function is then imported from the module (the hacks bring the
+        helpers they need, the virtual machine does not import them).
 
-    def next(self):
-        """ Reads and executes the next instruction
+        Args:
+            filename (string): path of the file
+            exclude (string, optional): skips the lines containing this text
+        """
+        with open(filename, "r") as file:
+            for line in file:
+                if not line.strip() or (exclude and exclude in line):
+                    continue
+                (cursor, code) = line.strip().split(":", 1)
+                if cursor.strip() == "native":
+                    self.bind(int(code.split("#")[0]))
+                elif cursor.strip().isidentifier():
+                    function = FUNCTION_NAME.fullmatch(code.split("#")[0].strip())
+                    if function:
+                        value = getattr(importlib.import_module(function.group(1)), function.group(2))
+                    else:
+                        compiled = compile(code.strip(), f"<{cursor.strip()}>", 'eval')
+                        value = eval(compiled, globals(), {**self.names, 'self': self})
+                    self.names[cursor.strip()] = value
+                else:
+                    self.hack(int(cursor), code)
+
+    def apply_hacks(self):
+        """ Evaluates the hacks registered at the current cursor
         """
         for hack in self.hacks[self.cursor]:
             #self.player.write(f"\nApplying hack, address = {self.cursor} : {hack}\n")
-            eval(hack)
+            hack(self)
+
+    def bind(self, address, function=None, validate=True):
+        """ Runs a Python implementation instead of the routine at address,
+        then returns to the caller as if ret had executed
+
+        Binding can be done before the program is loaded: the implementation is
+        validated the first time the routine is called. Binding an address
+        again replaces the implementation bound there.
+
+        Args:
+            address (int): address of the routine
+            function (callable, optional): implementation called with the virtual
+                                           machine. Defaults to the one in natives.
+            validate (bool, optional): first compares it with the interpreted
+                                       routine on its samples. Defaults to True.
+
+        Raises:
+            RuntimeException: (on the first call) if the implementation and the routine disagree
+        """
+        native = NATIVES[address] if function is None else Native(address, function)
+        validated = not validate
+        def call(virtual_machine):
+            nonlocal validated
+            if not validated:
+                virtual_machine.validate(native)
+                validated = True
+            native.function(virtual_machine)
+            virtual_machine.do_ret()
+        if address in self.natives:
+            self.hacks[address].remove(self.natives[address])
+        self.natives[address] = call
+        self.hack(address, call)
+
+    def validate(self, native):
+        """ Calls the routine of a native interpreted then natively for each
+        sample and compares registers, stacks and memory, the state is restored
+
+        Args:
+            native (Native): implementation to check
+
+        Raises:
+            RuntimeException: if the results differ
+        """
+        fork = self.fork()
+        try:
+            for sample in native.samples:
+                results = []
+                for run in (self.interpret_routine, native.function):
+                    self.resume(fork)
+                    for (register, value) in sample.items():
+                        self.memory.registers[register] = value
+                    self.do_call(native.address)
+                    run(self)
+                    if run is native.function:
+                        self.do_ret()
+                    results.append((self.memory.memory.tobytes(), self.stack.stack.tobytes(),
+                                    tuple(self.call_stack), self.cursor))
+                if results[0] != results[1]:
+                    raise RuntimeException(f"Native routine {native.address} differs from the program for {sample}")
+        finally:
+            self.resume(fork)
+
+    def interpret_routine(self, _=None, limit=10**8):
+        """ Runs the routine the virtual machine just called with the plain
+        interpreter (no hacks) until it returns
+
+        Args:
+            limit (int, optional): maximal number of instructions
+
+        Raises:
+            RuntimeException: if the routine halts or runs too long
+        """
+        (depth, routine) = (len(self.call_stack) - 1, self.call_stack[-1])
+        while len(self.call_stack) > depth:
+            instruction, args = self.next_instruction(self.cursor)
+            self.cursor += 1 + len(args)
+            if getattr(self, f'do_{instruction}'.strip())(*args) is False or not limit:
+                raise RuntimeException(f"Routine {routine} did not return")
+            limit -= 1
+
+    def next(self):
+        """ Reads and executes the next instruction
+        """
+        if self.hooked[self.cursor]:
+            self.apply_hacks()
         instruction, args = self.next_instruction(self.cursor)
         do_instruction = getattr(self, f'do_{instruction}'.strip())
         self.cursor += 1 + len(args)
@@ -189,7 +1051,8 @@ class VirtualMachine:
             address (int): address to start reading at
 
         Raises:
-            RuntimeException: if the operation is not defined
+            RuntimeException: if the operation is not defined or an argument is
+                neither a number nor a register
 
         Returns:
             (string, array) : operation and argument values
@@ -200,17 +1063,580 @@ class VirtualMachine:
         except KeyError as key_error:
             raise RuntimeException(f"Code {instruction_code} not defined") from key_error
         args = self.memory.read(address + 1, num_args)
+        if len(args) < num_args:
+            raise RuntimeException(f"Instruction at {address} runs past the end of memory")
+        for arg in args:
+            if arg >= MAX_ADDRESS + 8:
+                raise RuntimeException(f"Value {arg} is invalid as a number or a register")
         return do_name, args
 
+    def decode(self, address):
+        """ Decodes the instruction at address into a cached closure
+
+        The closure executes the instruction and returns the address of the
+        next one (-1 when the machine halts). Operands are resolved once here,
+        cases the fast closures do not cover fall back to the do_* handlers.
+        With superinstructions, the closure may run a whole fused sequence: the
+        words of the instructions after the first one are then marked like
+        those of a block so that writing them drops every decoded instruction.
+
+        Args:
+            address (int): address of the instruction
+
+        Returns:
+            function : closure executing the instruction
+        """
+        instruction, args = self.next_instruction(address)
+        instruction = instruction.strip()
+        following = address + 1 + len(args)
+        compiler = getattr(self, f'compile_{instruction}', None)
+        step = compiler(following, *args) if compiler else None
+        if step is None:
+            step = self.compile_generic(instruction, following, args)
+        self.memory.visited[address] = 1
+        covered = self.memory.covered
+        for word in range(address, following):
+            covered[word] = covered[word] or 1
+        if self.superinstructions is not None:
+            fused = self.superinstructions.fuse(self, address, step)
+            if fused is not None:
+                (step, end) = fused
+                covered[following:end] = bytes([2]) * (end - following)
+        self.memory.decoded[address] = step
+        return step
+
+    def compile_block(self, address):
+        """ Compiles the basic block starting at address into a Python function
+
+        The block runs straight-line code until a jmp, jt, jf, call, ret or
+        halt, keeping registers in local variables (written back however the
+        block is left, even by an exception). It stops early before an in, a
+        hacked address or anything it cannot compile, and leaves as soon as a
+        wmem touches decoded code. Blocks are cached for the current version
+        of the memory, a flush drops them all.
+
+        Args:
+            address (int): address of the first instruction
+
+        Returns:
+            function : function running the block and returning the next cursor,
+                       None if not even the first instruction can be compiled
+        """
+        version = self.memory.version
+        if version not in self.blocks:
+            self.blocks = {version: {}}
+        blocks = self.blocks[version]
+        if address not in blocks:
+            blocks[address] = self.build_block(address)
+        block = blocks[address]
+        if block is None:
+            return None
+        (step, end, starts) = block
+        self.memory.decoded[address] = step
+        visited = self.memory.visited
+        for start in starts:
+            visited[start] = 1
+        self.memory.covered[address:end] = bytes([2]) * (end - address)
+        return step
+
+    def build_block(self, address):
+        """ Generates and compiles the source of the block starting at address
+
+        Args:
+            address (int): address of the first instruction
+
+        Returns:
+            (function, int, list) : compiled block, the address following it
+                                    and the addresses of its instructions, or None
+        """
+        body, written, starts, cursor, terminated = [], [], [], address, False
+        while len(body) < MAX_BLOCK_LENGTH and cursor < MAX_ADDRESS and not terminated:
+            if cursor != address and self.hooked[cursor]:
+                break
+            try:
+                instruction, args = self.next_instruction(cursor)
+            except RuntimeException:
+                break
+            instruction = instruction.strip()
+            following = cursor + 1 + len(args)
+            lines = self.block_statement(instruction, args, following, written)
+            if lines is None:
+                break
+            body.append(lines)
+            starts.append(cursor)
+            cursor = following
+            terminated = instruction in ('jmp', 'jt', 'jf', 'call', 'ret', 'halt')
+        if not body:
+            return None
+        if not terminated:
+            body.append(self.block_exit(cursor))
+        lines = [line for statement in body for line in statement]
+        used = set(re.findall(r"\br[a-h]\b", "\n".join(lines)))
+        if written:
+            lines = ["try:"] + ["    " + line for line in lines] + ["finally:"] + [
+                f"    memory[{MAX_ADDRESS + REGISTER_NAMES.index(name)}] = {name}" for name in written]
+        source = "def block():\n" + "".join(
+            f"    {name} = memory[{MAX_ADDRESS + index}]\n"
+            for (index, name) in enumerate(REGISTER_NAMES) if name in used) + "".join(
+            f"    {line}\n" for line in lines)
+        namespace = {
+            'memory': self.memory.memory,
+            'covered': self.memory.covered,
+            'dirty': self.memory.dirty,
+            'invalidate': self.memory.invalidate,
+            'stack': self.stack.stack,
+            'call_stack': self.call_stack,
+            'output': self.output,
+            'vm': self,
+        }
+        exec(compile(source, f"<block {address}>", 'exec'), namespace)
+        return (namespace['block'], cursor, starts)
+
+    def block_exit(self, target):
+        """ Lines leaving the block, the modified registers are written back
+        by the finally clause around the body (see build_block)
+
+        Args:
+            target (string): expression of the next cursor
+
+        Returns:
+            list : lines of code
+        """
+        return [f"return {target}"]
+
+    def block_operand(self, operand):
+        """ Expression of an operand inside a block, None if invalid
+        """
+        if 0 <= operand < MAX_ADDRESS:
+            return str(operand)
+        if MAX_ADDRESS <= operand < MAX_ADDRESS + 8:
+            return REGISTER_NAMES[operand - MAX_ADDRESS]
+        return None
+
+    def block_statement(self, instruction, args, following, written):
+        """ Lines of code executing one instruction inside a block
+
+        Args:
+            instruction (string): name of the operation
+            args (array): raw arguments
+            following (int): address of the next instruction
+            written (list): names of the registers modified so far, updated in place
+
+        Returns:
+            list : lines of code, None if the instruction cannot be compiled
+        """
+        values = [self.block_operand(arg) for arg in args]
+        if None in values or instruction == 'in':
+            return None
+        expressions = {
+            'set': "{1}",
+            'pop': "stack.pop()",
+            'eq': "1 if {1} == {2} else 0",
+            'gt': "1 if {1} > {2} else 0",
+            'add': "({1} + {2}) & 32767",
+            'mult': "({1} * {2}) & 32767",
+            'mod': "{1} % {2}",
+            'and': "{1} & {2}",
+            'or': "{1} | {2}",
+            'not': "{1} ^ 32767",
+            'rmem': "memory[{1}] & 32767",
+        }
+        if instruction in expressions:
+            if self.register(args[0]) is None:
+                return None
+            if values[0] not in written:
+                written.append(values[0])
+            return [f"{values[0]} = " + expressions[instruction].format(*values)]
+        if instruction == 'push':
+            return [f"stack.append({values[0]})"]
+        if instruction == 'wmem':
+            return [f"address = {values[0]}",
+                    f"memory[address] = {values[1]}",
+                    "dirty[address >> 8] = 1",
+                    "if covered[address]:",
+                    "    invalidate(address)"] + \
+                ["    " + line for line in self.block_exit(following)]
+        if instruction == 'out':
+            if values[0] == "10":
+                return ["output.append('\\n')", "vm.flush_output()"]
+            if self.register(args[0]) is None:
+                return [f"output.append({chr(args[0])!r})"]
+            return [f"output.append(chr({values[0]}))",
+                    f"if {values[0]} == 10:",
+                    "    vm.flush_output()"]
+        if instruction == 'noop':
+            return ["pass"]
+        if instruction == 'jmp':
+            return self.block_exit(values[0])
+        if instruction == 'jt':
+            return self.block_exit(f"{values[1]} if {values[0]} else {following}")
+        if instruction == 'jf':
+            return self.block_exit(f"{following} if {values[0]} else {values[1]}")
+        if instruction == 'call':
+            return [f"stack.append({following})", f"call_stack.append({values[0]})"] + \
+                self.block_exit(values[0])
+        if instruction == 'ret':
+            return ["call_stack.pop()"] + self.block_exit("stack.pop()")
+        if instruction == 'halt':
+            return [f"vm.cursor = {following}", "vm.flush_output()"] + \
+                self.block_exit("-1")
+        return None
+
+    def source(self, operand):
+        """ Where the value of an operand can be read from
+
+        Args:
+            operand (int): literal value or register
+
+        Returns:
+            (sequence, int) : container and index holding the value, None if invalid
+        """
+        if 0 <= operand < MAX_ADDRESS:
+            return ((operand,), 0)
+        if MAX_ADDRESS <= operand < MAX_ADDRESS + 8:
+            return (self.memory.memory, operand)
+        return None
+
+    def register(self, operand):
+        """ Index of the register an operand refers to in the memory buffer
+
+        Args:
+            operand (int): register
+
+        Returns:
+            int : index of the register, None if the operand is not a register
+        """
+        if MAX_ADDRESS <= operand < MAX_ADDRESS + 8:
+            return operand
+        return None
+
+    def compile_generic(self, instruction, following, args):
+        """ closure delegating to the do_* handler
+        """
+        handler = getattr(self, f'do_{instruction}')
+        def step():
+            self.cursor = following
+            if handler(*args):
+                return self.cursor
+            return -1
+        return step
+
+    def compile_halt(self, following):
+        """ closure for halt
+        """
+        def step():
+            self.cursor = following
+            self.flush_output()
+            return -1
+        return step
+
+    def compile_set(self, following, a, b):
+        """ closure for set
+        """
+        target, value = self.register(a), self.source(b)
+        if target is None or value is None:
+            return None
+        words, (values, b) = self.memory.memory, value
+        def step():
+            words[target] = values[b]
+            return following
+        return step
+
+    def compile_push(self, following, a):
+        """ closure for push
+        """
+        value = self.source(a)
+        if value is None:
+            return None
+        values, a = value
+        stack = self.stack.stack
+        def step():
+            stack.append(values[a])
+            return following
+        return step
+
+    def compile_pop(self, following, a):
+        """ closure for pop
+        """
+        target = self.register(a)
+        if target is None:
+            return None
+        words, stack = self.memory.memory, self.stack.stack
+        def step():
+            words[target] = stack.pop()
+            return following
+        return step
+
+    def binary_operands(self, a, b, c):
+        """ Resolves the operands of an operation of the form a = b (op) c
+
+        Returns:
+            tuple : (words, target, lefts, b, rights, c), None if not supported
+        """
+        target, left, right = self.register(a), self.source(b), self.source(c)
+        if target is None or left is None or right is None:
+            return None
+        return (self.memory.memory, target) + left + right
+
+    def compile_eq(self, following, a, b, c):
+        """ closure for eq
+        """
+        operands = self.binary_operands(a, b, c)
+        if operands is None:
+            return None
+        words, target, lefts, b, rights, c = operands
+        def step():
+            words[target] = lefts[b] == rights[c]
+            return following
+        return step
+
+    def compile_gt(self, following, a, b, c):
+        """ closure for gt
+        """
+        operands = self.binary_operands(a, b, c)
+        if operands is None:
+            return None
+        words, target, lefts, b, rights, c = operands
+        def step():
+            words[target] = lefts[b] > rights[c]
+            return following
+        return step
+
+    def compile_add(self, following, a, b, c):
+        """ closure for add
+        """
+        operands = self.binary_operands(a, b, c)
+        if operands is None:
+            return None
+        words, target, lefts, b, rights, c = operands
+        def step():
+            words[target] = (lefts[b] + rights[c]) & 32767
+            return following
+        return step
+
+    def compile_mult(self, following, a, b, c):
+        """ closure for mult
+        """
+        operands = self.binary_operands(a, b, c)
+        if operands is None:
+            return None
+        words, target, lefts, b, rights, c = operands
+        def step():
+            words[target] = (lefts[b] * rights[c]) & 32767
+            return following
+        return step
+
+    def compile_mod(self, following, a, b, c):
+        """ closure for mod
+        """
+        operands = self.binary_operands(a, b, c)
+        if operands is None:
+            return None
+        words, target, lefts, b, rights, c = operands
+        def step():
+            words[target] = lefts[b] % rights[c]
+            return following
+        return step
+
+    def compile_and(self, following, a, b, c):
+        """ closure for and
+        """
+        operands = self.binary_operands(a, b, c)
+        if operands is None:
+            return None
+        words, target, lefts, b, rights, c = operands
+        def step():
+            words[target] = lefts[b] & rights[c]
+            return following
+        return step
+
+    def compile_or(self, following, a, b, c):
+        """ closure for or
+        """
+        operands = self.binary_operands(a, b, c)
+        if operands is None:
+            return None
+        words, target, lefts, b, rights, c = operands
+        def step():
+            words[target] = lefts[b] | rights[c]
+            return following
+        return step
+
+    def compile_not(self, following, a, b):
+        """ closure for not
+        """
+        target, value = self.register(a), self.source(b)
+        if target is None or value is None:
+            return None
+        words, (values, b) = self.memory.memory, value
+        def step():
+            words[target] = values[b] ^ 32767
+            return following
+        return step
+
+    def compile_jmp(self, following, a):
+        """ closure for jmp
+        """
+        value = self.source(a)
+        if value is None:
+            return None
+        values, a = value
+        if values is not self.memory.memory:
+            target = values[a]
+            return lambda: target
+        def step():
+            return values[a]
+        return step
+
+    def compile_jt(self, following, a, b):
+        """ closure for jt
+        """
+        condition, value = self.source(a), self.source(b)
+        if condition is None or value is None:
+            return None
+        (conditions, a), (values, b) = condition, value
+        if values is not self.memory.memory:
+            target = values[b]
+            def step():
+                return target if conditions[a] else following
+            return step
+        def step():
+            return values[b] if conditions[a] else following
+        return step
+
+    def compile_jf(self, following, a, b):
+        """ closure for jf
+        """
+        condition, value = self.source(a), self.source(b)
+        if condition is None or value is None:
+            return None
+        (conditions, a), (values, b) = condition, value
+        if values is not self.memory.memory:
+            target = values[b]
+            def step():
+                return following if conditions[a] else target
+            return step
+        def step():
+            return following if conditions[a] else values[b]
+        return step
+
+    def compile_rmem(self, following, a, b):
+        """ closure for rmem
+        """
+        target, value = self.register(a), self.source(b)
+        if target is None or value is None:
+            return None
+        words, (values, b) = self.memory.memory, value
+        def step():
+            words[target] = words[values[b]] & 32767
+            return following
+        return step
+
+    def compile_wmem(self, following, a, b):
+        """ closure for wmem
+        """
+        address, value = self.source(a), self.source(b)
+        if address is None or value is None:
+            return None
+        words, covered, dirty = self.memory.memory, self.memory.covered, self.memory.dirty
+        invalidate = self.memory.invalidate
+        (addresses, a), (values, b) = address, value
+        def step():
+            address = addresses[a]
+            words[address] = values[b]
+            dirty[address >> 8] = 1
+            if covered[address]:
+                invalidate(address)
+            return following
+        return step
+
+    def compile_call(self, following, a):
+        """ closure for call
+        """
+        value = self.source(a)
+        if value is None:
+            return None
+        values, a = value
+        call_stack, stack = self.call_stack, self.stack.stack
+        if values is not self.memory.memory:
+            target = values[a]
+            def step():
+                call_stack.append(target)
+                stack.append(following)
+                return target
+            return step
+        def step():
+            address = values[a]
+            call_stack.append(address)
+            stack.append(following)
+            return address
+        return step
+
+    def compile_ret(self, following):
+        """ closure for ret
+        """
+        call_stack, stack = self.call_stack, self.stack.stack
+        def step():
+            call_stack.pop()
+            return stack.pop()
+        return step
+
+    def compile_out(self, following, a):
+        """ closure for out
+        """
+        value = self.source(a)
+        if value is None:
+            return None
+        values, a = value
+        output, flush = self.output, self.flush_output
+        if values is not self.memory.memory and values[a] != 10:
+            char = chr(values[a])
+            def step():
+                output.append(char)
+                return following
+            return step
+        def step():
+            char = values[a]
+            output.append(chr(char))
+            if char == 10:
+                flush()
+            return following
+        return step
+
+    def compile_in(self, following, a):
+        """ closure for in
+        """
+        target = self.register(a)
+        if target is None:
+            return None
+        words, pending = self.memory.memory, self.pending
+        def step():
+            if pending:
+                words[target] = pending.pop()
+                return following
+            self.cursor = following - 2
+            words[target] = self.read_input()
+            self.cursor = following
+            return following
+        return step
+
+    def compile_noop(self, following):
+        """ closure for noop
+        """
+        def step():
+            return following
+        return step
+
     def do_halt(self):
         """ operation halt
         """
+        self.flush_output()
         return False
 
     def do_set(self, reg, value):
         """ operation set
         """
-        self.memory[reg] = self.memory.value(value)
+        self.memory.store(reg, self.memory.value(value))
         return True
 
     def do_push(self, value):
@@ -223,23 +1649,21 @@ class VirtualMachine:
     def do_pop(self, addr):
         """ operation pop
         """
-        self.memory[addr] = self.stack.pop()
+        self.memory.store(addr, self.stack.pop())
         return True
 
     def do_eq(self, a, b, c):
         """ operation eq
         """
-        b = self.memory.value(b)
-        c = self.memory.value(c)
-        self.memory[a] = 1 if b == c else 0
+        b, c = self.memory.values(b, c)
+        self.memory.store(a, 1 if b == c else 0)
         return True
 
     def do_gt(self, a, b, c):
         """ : operation gt
         """
-        b = self.memory.value(b)
-        c = self.memory.value(c)
-        self.memory[a] = 1 if b > c else 0
+        b, c = self.memory.values(b, c)
+        self.memory.store(a, 1 if b > c else 0)
         return True
 
     def do_jmp(self, addr):
@@ -252,8 +1676,7 @@ class VirtualMachine:
     def do_jt(self, a, addr):
         """ operation jt
         """
-        a = self.memory.value(a)
-        addr = self.memory.value(addr)
+        a, addr = self.memory.values(a, addr)
         if a:
             self.cursor = addr
         return True
@@ -261,8 +1684,7 @@ class VirtualMachine:
     def do_jf(self, a, addr):
         """ operation jf
         """
-        a = self.memory.value(a)
-        addr = self.memory.value(addr)
+        a, addr = self.memory.values(a, addr)
         if a == 0:
             self.cursor = addr
         return True
@@ -270,63 +1692,57 @@ class VirtualMachine:
     def do_add(self, a, b, c):
         """ operation add
         """
-        b = self.memory.value(b)
-        c = self.memory.value(c)
-        self.memory[a] = b + c
+        b, c = self.memory.values(b, c)
+        self.memory.store(a, b + c)
         return True
 
     def do_mult(self, a, b, c):
         """ operation mult
         """
-        b = self.memory.value(b)
-        c = self.memory.value(c)
-        self.memory[a] = b * c
+        b, c = self.memory.values(b, c)
+        self.memory.store(a, b * c)
         return True
 
     def do_mod(self, a, b, c):
         """ operation mod
         """
-        b = self.memory.value(b)
-        c = self.memory.value(c)
-        self.memory[a] = b % c
+        b, c = self.memory.values(b, c)
+        self.memory.store(a, b % c)
         return True
 
     def do_and(self, a, b, c):
         """ operation and
         """
-        b = self.memory.value(b)
-        c = self.memory.value(c)
-        self.memory[a] = b & c
+        b, c = self.memory.values(b, c)
+        self.memory.store(a, b & c)
         return True
 
     def do_or(self, a, b, c):
         """ operation or
         """
-        b = self.memory.value(b)
-        c = self.memory.value(c)
-        self.memory[a] = b | c
+        b, c = self.memory.values(b, c)
+        self.memory.store(a, b | c)
         return True
 
     def do_not(self, a, b):
         """ operation not
         """
         b = self.memory.value(b)
-        self.memory[a] = ~b
+        self.memory.store(a, ~b)
         return True
 
     def do_rmem(self, a, b):
         """ operation rmem
         """
         b = self.memory.value(b)
-        self.memory[a] = self.memory[b]
+        self.memory.store(a, self.memory.memory[b])
         return True
 
     def do_wmem(self, a, b):
         """ operation wmem
         """
-        a = self.memory.value(a)
-        b = self.memory.value(b)
-        self.memory[a] = b
+        a, b = self.memory.values(a, b)
+        self.memory.store(a, b)
         return True
 
     def do_call(self, addr):
@@ -348,15 +1764,21 @@ class VirtualMachine:
     def do_out(self, char):
         """ operation out
         """
-        char = chr(self.memory.value(char))
-        self.player.write(char)
+        char = self.memory.value(char)
+        self.output.append(chr(char))
+        if char == 10:
+            self.flush_output()
         return True
 
     def do_in(self, addr):
-        """ operation in
+        """ operation in (the cursor stays on the instruction while reading
+        so that a snapshot taken from the input resumes with this read)
         """
-        read = self.player.read()
-        self.memory[addr] = ord(read)
+        following = self.cursor
+        self.cursor = following - 2
+        read = self.read_input()
+        self.cursor = following
+        self.memory.store(addr, read)
         return True
 
     def do_noop(self):
@@ -365,9 +1787,62 @@ class VirtualMachine:
         return True
 
 
+class VirtualMachineFork:
+    """ Frozen state of a virtual machine, see VirtualMachine.fork
+
+    The memory is kept as immutable pages which are shared with the fork it
+    was derived from, so a fork only costs the pages it has written.
+    """
+    def __init__(self, pages, registers, stack, call_stack, cursor, pending):
+        self.pages = pages
+        self.registers = registers
+        self.stack = stack
+        self.call_stack = call_stack
+        self.cursor = cursor
+        self.pending = pending
+
+    def memory(self):
+        """ Contents of the memory
+
+        Returns:
+            array : the 32768 words of memory
+        """
+        return array('H', b''.join(self.pages))
+
+
+class OutputSink:
+    """ Headless output for batch runs: captures what the game writes, or
+    discards it
+    """
+    def __init__(self, capture=True):
+        self.capture = capture
+        self.data = bytearray()
+
+    def write(self, text):
+        """ Captures (or discards) text
+
+        Args:
+            text (string): text written by the game
+        """
+        if self.capture:
+            self.data += text.encode()
+
+    def text(self):
+        """ Captured output
+
+        Returns:
+            string : everything written so far
+        """
+        return self.data.decode()
+
+
 class RealPlayer:
     """ Play the game using console (stdin & stdout)
     """
+    def __init__(self, output=None):
+        self.output = output
+        self.virtual_machine = None
+
     def hack(self, virtual_machine) :
         """ Allows code to be run at specific moments
 
@@ -375,39 +1850,79 @@ class RealPlayer:
             virtual_machine (VirtualMachine): virtual machine
         """
         self.virtual_machine = virtual_machine
-    def write(self, char):
-        """ Displays character to the screen
+    def write(self, text):
+        """ Displays text to the screen
 
         Args:
-            char (string): one character to display
+            text (string): characters to display
         """
-        sys.stdout.write(char)
+        (self.output or sys.stdout).write(text)
 
-    def read(self):
-        """ Reads one character from screen
+    def read_line(self):
+        """ Reads one command from the console, running the "!" lines
 
         Returns:
-           string : input character
+           string : the command with its new line, empty at the end of the input
         """
-        char = sys.stdin.read(1)
-        while char == "!":
-            self.save_hack()
-            char = sys.stdin.read(1)
-        return char
+        line = sys.stdin.readline()
+        while line.startswith("!"):
+            self.save_hack(line[1:])
+            line = sys.stdin.readline()
+        return line
+
+    def tell(self):
+        """ Position in the input (the console cannot be replayed)
 
-    def save_hack(self) :
-        """ Adds a hack to the virtual machine
+        Returns:
+            int : always 0
         """
-        [cursor, code] = sys.stdin.readline().strip().split(":",1)
-        self.virtual_machine.hack(int(cursor), code)
+        return 0
+
+    def seek(self, position):
+        """ Moves in the input, nothing to do for the console
+
+        Args:
+            position (int): position returned by tell
+        """
+
+    def save_hack(self, command) :
+        """ Adds a hack to the virtual machine, or saves a snapshot with
+        "!save filename"
+
+        Args:
+            command (string): the line following "!"
+        """
+        try:
+            self.virtual_machine.escape(command)
+        except (SyntaxError, ValueError) as error:
+            self.write(f"Invalid command {command.strip()!r} : {error}\n")
 
 class FilePlayer :
-    """ Play the game using the commands from given file
+    """ Play the game using the commands from given file (lines starting with
+    "#" are comments, lines starting with "!" are run like on the console),
+    then from the console
     """
-    def __init__(self):
-        with open("Solution/solution.txt", "r") as file:
-            self.instructions = file.read()
+    def __init__(self, output=None, script="Solution/solution.txt"):
+        self.lines = self.stream(script)
         self.cursor = 0
+        self.output = output
+        self.console = RealPlayer(output)
+
+    def stream(self, script):
+        """ Lazily iterates over the lines of a script
+
+        Args:
+            script (string or iterable): path of the script, or any iterable
+                                         of lines such as an open file
+
+        Yields:
+            string : the lines of the script
+        """
+        if isinstance(script, str):
+            with open(script, "r") as file:
+                yield from file
+        else:
+            yield from script
 
     def hack(self, virtual_machine) :
         """ Adds code to be run at specific moments
@@ -415,38 +1930,162 @@ class FilePlayer :
         Args:
             virtual_machine (VirtualMachine): virtual machine
         """
-        with open("Solution/hacks.yml", "r") as file:
-            for line in file.readlines():
-                [cursor, code] = line.strip().split(":",1)
-                virtual_machine.hack(int(cursor), code)
-    def write(self, char):
-        """ Displays a character to the screen
+        self.console.hack(virtual_machine)
+        virtual_machine.load_hacks("Solution/hacks.yml")
+    def write(self, text):
+        """ Displays text to the screen
+
+        Args:
+            text (string): the characters to display
+        """
+        (self.output or sys.stdout).write(text)
+
+    def read_line(self):
+        """ Returns the next command of the script, echoing it
+
+        Returns:
+            string : the command with its new line, empty at the end of the input
+        """
+        for line in self.lines:
+            self.cursor = self.cursor + 1
+            if line.startswith("#"):
+                continue
+            if line.startswith("!"):
+                self.console.save_hack(line[1:])
+                continue
+            line = line if line.endswith("\n") else line + "\n"
+            self.write(line)
+            return line
+        return self.console.read_line()
+
+    def tell(self):
+        """ Position in the script
+
+        Returns:
+            int : number of lines already read
+        """
+        return self.cursor
+
+    def seek(self, position):
+        """ Skips lines of the script, the script being a stream it can only
+        move forward
+
+        Args:
+            position (int): position returned by tell
+
+        Raises:
+            RuntimeException: if position is before the current one
+        """
+        if position < self.cursor:
+            raise RuntimeException(f"Cannot go back to line {position} of the script")
+        for _ in range(position - self.cursor):
+            next(self.lines, None)
+        self.cursor = position
+
+class ScriptedPlayer:
+    """ Plays a list of commands and keeps the output instead of displaying it
+    """
+    def __init__(self, commands):
+        self.commands = list(commands)
+        self.cursor = 0
+        self.output = []
+
+    def hack(self, virtual_machine) :
+        """ No hacks for scripted players
 
         Args:
-            char (string): the character to display
+            virtual_machine (VirtualMachine): virtual machine
         """
-        sys.stdout.write(char)
-    def read(self):
-        """ Returns one character of current instruction
+
+    def write(self, text):
+        """ Keeps the output
+
+        Args:
+            text (string): the characters to keep
         """
-        char = self.read_char()
-        while char == "!":
-            char = self.read_char()
-        return char
+        self.output.append(text)
+
+    def read_line(self):
+        """ Returns the next command
 
-    def read_char(self) :
-        """ Reads one char
+        Raises:
+            WaitingForInput: once every command has been read
         """
-        if self.cursor >= len(self.instructions):
-            return sys.stdin.read(1)
-        char = self.instructions[self.cursor]
+        if self.cursor >= len(self.commands):
+            raise WaitingForInput()
         self.cursor = self.cursor + 1
-        sys.stdout.write(char)
-        return char
+        return self.commands[self.cursor - 1] + "\n"
+
+    def tell(self):
+        """ Position in the commands
+
+        Returns:
+            int : number of commands already read
+        """
+        return self.cursor
+
+    def seek(self, position):
+        """ Moves in the commands
+
+        Args:
+            position (int): position returned by tell
+        """
+        self.cursor = position
+
+    def text(self):
+        """ Output kept so far
+
+        Returns:
+            string : the output
+        """
+        return "".join(self.output)
 
 if __name__ == '__main__':
-    player = FilePlayer()
-    vm = VirtualMachine(player)
+    parser = argparse.ArgumentParser(description="Plays the challenge using a solution script")
+    parser.add_argument('--no-jit', action='store_true',
+                        help="only use the pre-decoded instruction cache")
+    parser.add_argument('--interpreter', action='store_true',
+                        help="use the plain step by step interpreter")
+    parser.add_argument('--interactive', action='store_true',
+                        help="play from the console instead of Solution/solution.txt")
+    parser.add_argument('--restore', metavar='SNAPSHOT',
+                        help="resume from a snapshot instead of booting")
+    parser.add_argument('--headless', action='store_true',
+                        help="discard the output of the game")
+    parser.add_argument('--script', default="Solution/solution.txt",
+                        help="commands to play before the console, - for the standard input")
+    parser.add_argument('--profile', metavar='REPORT',
+                        help="count the executed instructions and write a report")
+    parser.add_argument('--trace', metavar='TRACE',
+                        help="record every executed instruction into a binary trace (see tracer.py)")
+    parser.add_argument('--fuse', action='store_true',
+                        help="fuse recurring instruction sequences of the decoded instructions "
+                             "(with --no-jit) and print how often each one ran")
+    parser.add_argument('--cold', action='store_true',
+                        help=f"boot from the program without the boot images of {BOOT_CACHE}")
+    arguments = parser.parse_args()
+    output = OutputSink(capture=False) if arguments.headless else None
+    if arguments.interactive:
+        player = RealPlayer(output)
+    else:
+        player = FilePlayer(output, sys.stdin if arguments.script == "-" else arguments.script)
+    vm = VirtualMachine(player, fast=not arguments.interpreter, jit=not arguments.no_jit, fuse=arguments.fuse)
     player.hack(vm)
-    vm.load("Program/challenge.bin")
+    if arguments.cold or arguments.restore or arguments.profile or arguments.trace:
+        vm.load("Program/challenge.bin")
+    else:
+        vm.boot("Program/challenge.bin")
+    if arguments.restore:
+        vm.load_snapshot(arguments.restore)
+    if arguments.profile:
+        vm.profiler = Profiler()
+    elif arguments.trace:
+        vm.tracer = Tracer(arguments.trace)
     vm.run()
+    if vm.tracer is not None:
+        vm.tracer.close()
+    if vm.superinstructions is not None:
+        vm.superinstructions.report(sys.stderr)
+    if arguments.profile:
+        with open(arguments.profile, 'w') as report:
+            vm.profiler.report(vm, report)